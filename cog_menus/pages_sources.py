@@ -33,6 +33,27 @@ class ParseSource(menus.ListPageSource):
         return embed
 
 
+class RosterSource(menus.ListPageSource):
+    def __init__(self, title, data, missing):
+        self.title = title
+        # characters which couldn't be found on fflogs
+        self.missing = missing
+        super().__init__(data, per_page=1)
+
+    async def format_page(self, menu, page):
+        encounter, lines = page
+        embed = discord.Embed(title=self.title, color=0x00dcff)
+        embed.description = f"**{encounter}**\n{lines}"
+
+        text = f"page {menu.current_page + 1} /{self.get_max_pages()}"
+
+        if self.missing:
+            text += f"\nnot found on fflogs: {', '.join(self.missing)}"
+
+        embed.set_footer(text=text)
+        return embed
+
+
 class GamerScapeSource(menus.ListPageSource):
     def __init__(self, model, data):
         self.item = model
@@ -1,61 +1,230 @@
+import sys
+import time
+import enum
+import traceback
 import asyncio
 import re
-import difflib
 import typing
 
 from collections import namedtuple
+from datetime import datetime, timezone
 
 import discord
 
 from discord.ext import commands
 
-from bs4 import BeautifulSoup
-
 from asyncpg import Record
 
-from oauthlib.oauth2 import BackendApplicationClient
-from oauthlib.oauth2.rfc6749.errors import MissingTokenError
-
-from async_oauthlib import OAuth2Session
+import aiohttp
 
-from python_graphql_client import GraphqlClient
+from oauthlib.oauth2.rfc6749.errors import MissingTokenError
 
 from config import config
-from config.utils.converters import CharacterAndWorldConverter
+from config.utils.converters import CharacterAndWorldConverter, RefreshConverter
 from config.utils.emojis import ICONS
 from config.utils import cache
-from config.utils import context
+from config.utils.scraping import FFlogsSearchPage
+from config.utils.requests import RequestFailed, Unauthorized
+from config.utils.catalog import Difficulty
 
-from cog_menus.pages_sources import ParseSource, SearchSource
+from cog_menus.pages_sources import ParseSource, SearchSource, RosterSource
 
 from cogs.error_handler import ParsesNotFound, CharacterNotFound
 
 FFLOGS_OAUTH_URL = "https://www.fflogs.com/oauth/token"
 FFLOGS_URL = "https://www.fflogs.com/api/v2/client"
+# seconds before a token expires that it's refreshed
+TOKEN_LEEWAY = 300
+# seconds character parses are cached for
+PARSE_TTL = 300
+# characters aliased into a single query before fflogs' complexity limit makes it split further
+ROSTER_BATCH_SIZE = 8
+# saved characters warmed per pass, seconds between passes and how long warmed parses are kept
+WARM_LIMIT = 64
+WARM_INTERVAL = 1800
+WARM_TTL = 6 * 3600
+# added to every query so the points spent are known without a separate request
+RATE_LIMIT_FIELDS = "rateLimitData { limitPerHour pointsSpentThisHour pointsResetIn }"
+
+
+# options for a single command passed down to the query and the strings built from it
+ParseOptions = namedtuple("ParseOptions", "metric savage_only refresh", defaults=("rdps", False, False))
+
+
+class Priority(enum.Enum):
+    interactive = 1
+    background = 2
+
+
+class BudgetExhausted(RequestFailed):
+    pass
+
+
+def character_name_key(character):
+    return character["world"].lower(), character["first_name"].lower(), character["second_name"].lower()
+
+
+def character_data_key(cog, character, region, difficulties, options, encounters=None, zones=None):
+    # only the metric changes the query so rdps and adps are cached separately
+    name = character_name_key(character)
+    return (name, cog.generations.get(name, 0), region, tuple(sorted(d.diff_id for d in difficulties)),
+            tuple(encounters or ()), tuple(zones or ()), options.metric)
+
+
+class RateBudget:
+    """Points spent against the fflogs hourly limit as last reported by rateLimitData.
+
+    Once less than ``reserve`` of the limit is left background work either waits
+    for the reset or is shed, so interactive commands get what remains.
+    """
+
+    def __init__(self, reserve=0.2):
+        self.reserve = reserve
+        self.limit = None
+        self.spent = 0
+        self.reset_at = None
+        # background requests waiting for the reset, shed and interactive requests refused
+        self.queued = 0
+        self.shed = 0
+        self.refused = 0
+
+    def update(self, data):
+        self.limit = data["limitPerHour"]
+        self.spent = data["pointsSpentThisHour"]
+        self.reset_at = time.monotonic() + data["pointsResetIn"]
+
+    @property
+    def resets_in(self):
+        return max(self.reset_at - time.monotonic(), 0) if self.reset_at is not None else 0
+
+    @property
+    def remaining(self):
+        if self.limit is None:
+            return None
+
+        if self.reset_at is not None and self.resets_in == 0:
+            self.spent = 0
+            self.reset_at = None
+
+        return self.limit - self.spent
+
+    async def acquire(self, priority, shed=False):
+        remaining = self.remaining
+
+        if remaining is None:
+            # nothing has been reported yet
+            return
+
+        if priority is Priority.interactive:
+
+            if remaining <= 0:
+                self.refused += 1
+                raise BudgetExhausted(f"the fflogs api limit for this hour has been reached, try again in "
+                                      f"{self.resets_in / 60:.0f} minutes.")
+
+            return
+
+        while remaining < self.limit * self.reserve:
+
+            if shed:
+                self.shed += 1
+                raise BudgetExhausted(f"the fflogs api budget is being saved for commands, try again in "
+                                      f"{self.resets_in / 60:.0f} minutes.")
+
+            self.queued += 1
+
+            try:
+                await asyncio.sleep(self.resets_in + 1)
+            finally:
+                self.queued -= 1
+
+            remaining = self.remaining
 
 
 class FFlogsAPI:
-    def __init__(self):
-        self.client = GraphqlClient(FFLOGS_URL)
-        token_client = BackendApplicationClient(client_id=config.__fflogs_client_id__)
-        self.oauth = OAuth2Session(client=token_client)
-
-    async def get_bearer_token(self):
-        # access tokens for OAuth 2.0
-        token = await self.oauth.fetch_token(token_url=FFLOGS_OAUTH_URL, client_id=config.__fflogs_client_id__,
-                                             client_secret=config.__fflogs_client_secret__)
+    # queries and the token exchange go through the bot's Request so they share its
+    # keep-alive session, timeouts and the fflogs host limits
+    def __init__(self, request):
+        self.request = request
+        self.auth = aiohttp.BasicAuth(config.__fflogs_client_id__, config.__fflogs_client_secret__)
+        self.token = None
+        self.__refresh = None
+        self.budget = RateBudget()
+
+    def token_valid(self):
+        return self.token is not None and self.token.get("expires_at", 0) - TOKEN_LEEWAY > time.time()
+
+    async def fetch_token(self):
+        # access tokens for OAuth 2.0 using the client credentials grant
+        if getattr(self.request.session, "offline", False):
+            return {"access_token": "replay", "expires_in": 3600, "expires_at": time.time() + 3600}
+
+        token = await self.request.post(FFLOGS_OAUTH_URL, data={"grant_type": "client_credentials"}, auth=self.auth)
+
+        if "access_token" not in token:
+            raise MissingTokenError()
+
         return token
 
-    async def call_fflogs_api(self, query, variables, token):
-        # making a request with query defined variables and access token
-        headers = {
-            "Content-Type": "application/json",
-            "Authorization": f"Bearer {token['access_token']}"
-        }
-        data = await self.client.execute_async(query=query, variables=variables, headers=headers)
+    async def __refresh_token(self):
+        try:
+            token = await self.fetch_token()
+            token.setdefault("expires_at", time.time() + token.get("expires_in", 0))
+            self.token = token
+            return token
+        finally:
+            self.__refresh = None
+
+    async def get_bearer_token(self, force=False):
+        # reuses the current token until it's about to expire, concurrent callers share one refresh
+        if not force and self.token_valid():
+            return self.token
+
+        if self.__refresh is None:
+            self.token = None
+            self.__refresh = asyncio.ensure_future(self.__refresh_token())
+
+        return await asyncio.shield(self.__refresh)
+
+    async def execute(self, query, variables, token):
+        headers = {"Authorization": f"Bearer {token['access_token']}"}
+        body = {"query": query, "variables": variables}
+
+        return await self.request.post(FFLOGS_URL, json=body, headers=headers)
+
+    @staticmethod
+    def with_rate_limit(query):
+        # the first brace opens the query's selection set, variable definitions can't contain one
+        i = query.index("{") + 1
+        return f"{query[:i]}\n{RATE_LIMIT_FIELDS}{query[i:]}"
+
+    def record_rate_limit(self, data):
+        rate_limit = (data.get("data") or {}).pop("rateLimitData", None)
+
+        if rate_limit:
+            self.budget.update(rate_limit)
 
         return data
 
+    async def call_fflogs_api(self, query, variables=None, priority=Priority.interactive, shed=False):
+        # making a request with query defined variables and access token
+        # background work is held back or shed with shed=True when the hourly budget is running low
+        await self.budget.acquire(priority, shed)
+
+        query = self.with_rate_limit(query)
+        token = await self.get_bearer_token()
+
+        try:
+
+            data = await self.execute(query, variables, token)
+
+        except Unauthorized:
+            # expired early or was revoked, only refreshed if another request hasn't already
+            token = await self.get_bearer_token(force=token is self.token)
+            data = await self.execute(query, variables, token)
+
+        return self.record_rate_limit(data)
+
 
 class FFlogs(commands.Cog):
     """
@@ -64,16 +233,27 @@ class FFlogs(commands.Cog):
 
     def __init__(self, bot):
         self.bot = bot
-        self.api = FFlogsAPI()
-        self.metric = "rdps"
+        self.api = FFlogsAPI(bot.request)
         self.job_dict = ICONS
-        self.current_dungeons = None
         self.current_tier_id = None
         self.encounter_regex = None
+        self.catalog = bot.catalog
+        # bumped when a character is re-registered so their cached parses aren't used
+        self.generations = {}
+        # user id -> when they last ran a command from this cog, written to lodestone_user each warming pass
+        self.activity = {}
+        self.warmed = 0
+        self.last_warmed = None
         bot.loop.create_task(self.__ainit__())
+        self.warmer = bot.loop.create_task(self.warm_parse_cache())
 
     def cog_unload(self):
-        asyncio.ensure_future(self.api.oauth.close())
+        self.warmer.cancel()
+
+    @commands.Cog.listener()
+    async def on_command(self, ctx):
+        if ctx.cog is self:
+            self.activity[ctx.author.id] = datetime.now(timezone.utc)
 
     @commands.Cog.listener()
     async def on_command_error(self, ctx, error):
@@ -81,6 +261,13 @@ class FFlogs(commands.Cog):
             # if this is called an invalid client details was passed or FFlogs is down
             return await ctx.send("> FFlogs seems to be down", delete_after=4)
 
+    @commands.Cog.listener()
+    async def on_character_update(self, *characters):
+        for character in characters:
+            if character:
+                name = character_name_key(character)
+                self.generations[name] = self.generations.get(name, 0) + 1
+
     async def __ainit__(self):
         # getting the current zone id by passing nothing to zoneRankings
         # doing this since zoneRanking inherently does not return all reports as it's a 1-1
@@ -99,35 +286,24 @@ class FFlogs(commands.Cog):
 
                   }
               """
-        token = await self.api.get_bearer_token()
-        headers = {
-            "Content-Type": "application/json",
-            "Authorization": f"Bearer {token['access_token']}"
-        }
-
-        data = await self.api.client.execute_async(query=query, headers=headers)
+        data = await self.api.call_fflogs_api(query=query)
         self.current_tier_id = data["data"]["characterData"]["character"]["zoneRankings"]["zone"]
 
-        async with self.bot.pool.acquire() as con:
-            names = await con.fetch("SELECT DISTINCT name from difficulties")
-            # building a regex to match difficulty name followed by it's respective id
-            self.encounter_regex = re.compile(r"(%s)" % "|".join(n["name"] + r"\d*" for n in names))
-            dungeons = await con.fetch("SELECT id, expansion_name FROM zone WHERE name like 'Dungeon%'")
-            dungeons = [x["id"] for x in dungeons]
-            self.current_dungeons = dungeons
+        self.build_encounter_regex()
 
-    async def cog_after_invoke(self, ctx):
-        # set the metric back rdps
-        self.metric = "rdps"
+    def build_encounter_regex(self):
+        # building a regex to match difficulty name followed by it's respective id
+        self.encounter_regex = re.compile(r"(%s)" % "|".join(n + r"\d*" for n in self.catalog.difficulty_names))
 
-    @staticmethod
-    async def get_difficulties_ids_by_zone(ctx, zone_id):
-        return await ctx.db.fetch("SELECT name, diff_id FROM difficulties WHERE zone_id = $1", zone_id)
+    async def reload_catalog(self, ctx):
+        await self.catalog.load(ctx.db)
+        self.build_encounter_regex()
 
-    @staticmethod
-    async def get_encounters_by_zone(ctx, zone_id):
-        return await ctx.db.fetch("""SELECT e.id from encounter e INNER JOIN zone z ON e.zone_id  = z.id
-                                     WHERE e.zone_id = $1 """, zone_id)
+    def get_difficulties_ids_by_zone(self, zone_id):
+        return self.catalog.difficulties.get(zone_id, ())
+
+    def get_encounters_by_zone(self, zone_id):
+        return list(self.catalog.zone_encounters.get(zone_id, ()))
 
     #  @staticmethod
     #  async def get_trials_zone(ctx, expansion_name):
@@ -170,7 +346,8 @@ class FFlogs(commands.Cog):
 
         self.filter_out_parses(ranks, 100)
 
-    def build_sub_fields(self, rtype, difficulties: typing.Union[list, Record], ranking_ids):
+    @staticmethod
+    def build_sub_fields(rtype, difficulties: typing.Sequence[Difficulty], ranking_ids, options: ParseOptions):
         base = ""
 
         for rid in ranking_ids:
@@ -178,8 +355,8 @@ class FFlogs(commands.Cog):
             # for multiple encounter/zoneRankings an alias is needed so opting to use it's id suffixed with it's
             # difficulty name
             for r in difficulties:
-                base += f"{r['name']}{rid}: {rtype}Rankings(difficulty: {r['diff_id']} " \
-                        f"{rtype}ID: {rid} metric: {self.metric} {frame})\n"
+                base += f"{r.name}{rid}: {rtype}Rankings(difficulty: {r.diff_id} " \
+                        f"{rtype}ID: {rid} metric: {options.metric} {frame})\n"
 
         sub_fields = f"""
                   {{canonicalID
@@ -193,45 +370,29 @@ class FFlogs(commands.Cog):
     def get_job_emote(self, spec: str):
         return self.job_dict[spec]
 
-    async def get_zone(self, ctx, name):
+    def get_zone(self, name):
 
-        zone = await ctx.db.fetchval("SELECT id FROM zone WHERE LOWER(name) like $1", name.lower() + "%")
+        zone = self.catalog.find_zone(name)
 
-        if zone in self.current_dungeons:
-            current_dungeon = await ctx.db.fetchval("""SELECT z.id from zone z
-                                                       INNER JOIN bracket b on b.expansion_name = z.expansion_name
-                                                       WHERE z.id = ANY($1::INT[]) ORDER BY b.max DESC"""
-                                                    , self.current_dungeons)
-            return current_dungeon
+        if zone in self.catalog.dungeons:
+            return self.catalog.current_dungeon()
 
         return zone
 
-    async def invoke_best(self, ctx, command_name, *args, **kwargs):
-        # set the metric to adps
-        self.metric = "dps"
-        # optional string args followed by a subcommand doesn't work well if you invoke the main group
-        cmd = self.bot.get_command(command_name)
-
-        await cmd(ctx, *args, **kwargs)
-
-    @cache.cache()
-    # caching because it's slightly faster and build_zone_string adds up with many encounters
-    async def get_encounter_name_by_id(self, ctx, encounter_id):
-        return await ctx.db.fetchval("SELECT name FROM encounter WHERE id = $1", encounter_id)
-
-    async def get_character_data(self, character, region, difficulties, encounters: list = None, zones: list = None):
+    @cache.cache(maxsize=256, strategy=cache.Strategy.timed, ttl=PARSE_TTL, key=character_data_key,
+                 max_bytes=16 * 1024 * 1024)
+    async def query_character_data(self, character, region, difficulties, options: ParseOptions,
+                                   encounters: list = None, zones: list = None):
 
         name = character["first_name"] + " " + character["second_name"]
 
         if encounters:
-            sub_fields = self.build_sub_fields("encounter", difficulties, encounters)
+            sub_fields = self.build_sub_fields("encounter", difficulties, encounters, options)
         elif zones:
-            sub_fields = self.build_sub_fields("zone", difficulties, zones)
+            sub_fields = self.build_sub_fields("zone", difficulties, zones, options)
         else:
             raise commands.BadArgument("An encounter id(s) or zone id(s) needs to be passed.")
 
-        token = await self.api.get_bearer_token()
-
         variables = {
             "name": name,
             "serverSlug": character["world"],
@@ -250,13 +411,28 @@ class FFlogs(commands.Cog):
           }}
         }}"""
 
-        data = await self.api.call_fflogs_api(query=query, variables=variables, token=token)
+        data = await self.api.call_fflogs_api(query=query, variables=variables)
 
         world = character["world"]
 
         if not data["data"]["characterData"]["character"]:
             raise CharacterNotFound(f"The **character** \"{name}\" for world **{world}** does not exist on fflogs.")
 
+        self.save_parses([(data["data"]["characterData"]["character"], region)], options.metric)
+
+        return data
+
+    async def get_character_data(self, character, region, difficulties, options: ParseOptions,
+                                 encounters: list = None, zones: list = None):
+
+        if options.refresh:
+            self.query_character_data.invalidate(self, character, region, difficulties, options, encounters, zones)
+
+        data = await self.query_character_data(character, region, difficulties, options, encounters, zones)
+
+        name = character["first_name"] + " " + character["second_name"]
+        world = character["world"]
+        # built fresh each call since savage_only filters it in place
         ranks = []
         for key in data["data"]["characterData"]["character"].keys():
             # encounterRankings or zoneRankings are aliased as difficulty name followed by their respective id
@@ -267,8 +443,332 @@ class FFlogs(commands.Cog):
         if not ranks:
             raise ParsesNotFound(f"No parses were found for the **character** \"{name}\" for world **{world}**.")
 
+        if options.savage_only:
+            self.savage_only(ranks, character)
+
         return data, ranks
 
+    @staticmethod
+    def complexity_exceeded(data):
+        return any("complexity" in error.get("message", "").lower() for error in data.get("errors") or ())
+
+    async def get_roster_batch(self, batch, sub_fields, priority=Priority.interactive, shed=False):
+        # each character is aliased as c followed by it's index in the roster
+        variables = {}
+        arguments = []
+        fields = ""
+
+        for i, character in batch:
+            variables[f"name{i}"] = character["first_name"] + " " + character["second_name"]
+            variables[f"server{i}"] = character["world"]
+            variables[f"region{i}"] = character["region"]
+            arguments.append(f"$name{i}: String!, $server{i}: String!, $region{i}: String!")
+            fields += f"""
+            c{i}: character(name: $name{i} serverSlug: $server{i} serverRegion: $region{i})
+            {sub_fields}"""
+
+        query = f"""
+        query ({", ".join(arguments)}) {{
+          characterData{{
+            {fields}
+          }}
+        }}"""
+
+        data = await self.api.call_fflogs_api(query=query, variables=variables, priority=priority, shed=shed)
+
+        if self.complexity_exceeded(data):
+
+            if len(batch) == 1:
+                raise commands.BadArgument("This tier has too many encounters for fflogs to return in one query.")
+
+            # splitting the batch in half until fflogs accepts it
+            middle = len(batch) // 2
+            first, second = await asyncio.gather(self.get_roster_batch(batch[:middle], sub_fields, priority, shed),
+                                                 self.get_roster_batch(batch[middle:], sub_fields, priority, shed))
+            return {**first, **second}
+
+        character_data = (data.get("data") or {}).get("characterData")
+
+        if character_data is None:
+            errors = ", ".join(error.get("message", "") for error in data.get("errors") or ())
+            raise RequestFailed(f"fflogs couldn't answer the roster query `{errors or 'no data was returned'}`.")
+
+        return {i: character_data.get(f"c{i}") for i, _ in batch}
+
+    async def get_roster_data(self, characters, difficulties, encounters, options: ParseOptions,
+                              priority=Priority.interactive, shed=False):
+        # returns a list of each character paired with their character data or None if they're not on fflogs
+        sub_fields = self.build_sub_fields("encounter", difficulties, encounters, options)
+        # characters saved with a world that isn't known have no region and can't be looked up
+        indexed = [(i, character) for i, character in enumerate(characters) if character["region"]]
+        batches = [indexed[i:i + ROSTER_BATCH_SIZE] for i in range(0, len(indexed), ROSTER_BATCH_SIZE)]
+
+        results = {}
+        for result in await asyncio.gather(*(self.get_roster_batch(batch, sub_fields, priority, shed)
+                                             for batch in batches)):
+            results.update(result)
+
+        roster = [(character, results.get(i)) for i, character in enumerate(characters)]
+        self.save_parses([(data, character["region"]) for character, data in roster if data], options.metric)
+
+        return roster
+
+    async def flush_activity(self):
+        activity, self.activity = self.activity, {}
+
+        if activity:
+            await self.bot.pool.execute("""UPDATE lodestone_user SET last_active = a.at
+                                           FROM unnest($1::BIGINT[], $2::TIMESTAMPTZ[]) AS a(user_id, at)
+                                           WHERE lodestone_user.user_id = a.user_id""",
+                                        list(activity.keys()), list(activity.values()))
+
+    async def warm_pass(self):
+        # the same query tierlogs makes, batched, so its cache key is filled in for each character
+        await self.flush_activity()
+
+        characters = await self.bot.pool.fetch("""SELECT first_name, second_name, world_name as world, region
+                                                  FROM lodestone_user WHERE first_name IS NOT NULL
+                                                  ORDER BY last_active DESC NULLS LAST LIMIT $1""", WARM_LIMIT)
+
+        if not characters:
+            return
+
+        difficulties = self.get_difficulties_ids_by_zone(self.current_tier_id)
+        encounters = self.get_encounters_by_zone(self.current_tier_id)
+        options = ParseOptions()
+
+        roster = await self.get_roster_data(characters, difficulties, encounters, options,
+                                            priority=Priority.background, shed=True)
+
+        for character, data in roster:
+
+            if not data:
+                continue
+
+            region = self.catalog.region(character["world"])
+            self.query_character_data.prime({"data": {"characterData": {"character": data}}}, self, character,
+                                            region, difficulties, options, encounters, ttl=WARM_TTL)
+            self.warmed += 1
+
+        self.last_warmed = datetime.now(timezone.utc)
+
+    async def warm_parse_cache(self):
+        # runs every WARM_INTERVAL seconds during config.FFLOGS_WARM_HOURS once the current tier is known
+        await self.bot.wait_until_ready()
+
+        while True:
+
+            if self.current_tier_id is not None and datetime.now(timezone.utc).hour in config.FFLOGS_WARM_HOURS:
+
+                try:
+                    await self.warm_pass()
+                except (RequestFailed, aiohttp.ClientError, asyncio.TimeoutError):
+                    # shed once the budget runs low or fflogs is having problems, tried again next pass
+                    pass
+                except Exception as e:
+                    # anything else would end the task for good, it's reported and tried again next pass
+                    print("Ignoring exception in the parse cache warming pass:", file=sys.stderr)
+                    traceback.print_exception(type(e), e, e.__traceback__, file=sys.stderr)
+
+            await asyncio.sleep(WARM_INTERVAL)
+
+    def snapshot_rows(self, character_data, metric):
+        # one row per encounter and difficulty from either encounter or zone rankings, skipping anything uncleared
+        rows = []
+
+        for key, value in character_data.items():
+
+            if not self.encounter_regex.match(key) or not value:
+                continue
+
+            difficulty = value["difficulty"]
+            metric = value.get("metric", metric)
+
+            if "rankings" in value:
+                rows.extend((r["encounter"]["id"], difficulty, metric, r["rankPercent"], r["bestAmount"],
+                             r["totalKills"], int(r["fastestKill"]), r["bestSpec"])
+                            for r in value["rankings"] if r["totalKills"])
+
+            elif value["totalKills"] and value["ranks"]:
+                best = max(value["ranks"], key=lambda parse: parse["rankPercent"])
+                rows.append((int(re.sub(r"[a-zA-Z]", "", key)), difficulty, metric, best["rankPercent"],
+                             value["bestAmount"], value["totalKills"], int(value["fastestKill"]), best["spec"]))
+
+        return rows
+
+    async def record_parses(self, characters, metric):
+        # keeps each day's best parses so history can be shown without asking fflogs again,
+        # characters is a list of character data and region pairs written in one transaction
+        character_rows = {}
+        snapshot_rows = []
+
+        for character_data, region in characters:
+            rows = self.snapshot_rows(character_data, metric)
+
+            if not rows:
+                continue
+
+            character_id = character_data["canonicalID"]
+            character_rows[character_id] = (character_id, character_data["name"], character_data["server"]["name"],
+                                            region)
+            snapshot_rows.extend((character_id, *row) for row in rows)
+
+        if not character_rows:
+            return
+
+        async with self.bot.pool.acquire() as con:
+            async with con.transaction():
+                await con.executemany("""INSERT INTO fflogs_character (id, name, world, region)
+                                         VALUES ($1, $2, $3, $4) ON CONFLICT (id) DO UPDATE
+                                         SET name = $2, world = $3, region = $4, updated_at = now()""",
+                                      list(character_rows.values()))
+
+                await con.executemany("""INSERT INTO parse_snapshot (character_id, encounter_id, difficulty, metric,
+                                                                     best_percent, best_amount, total_kills,
+                                                                     fastest_kill, spec)
+                                         VALUES ($1, $2, $3, $4, $5, $6, $7, $8, $9)
+                                         ON CONFLICT (character_id, encounter_id, difficulty, metric, day) DO UPDATE
+                                         SET best_percent = EXCLUDED.best_percent, best_amount = EXCLUDED.best_amount,
+                                             total_kills = EXCLUDED.total_kills,
+                                             fastest_kill = EXCLUDED.fastest_kill, spec = EXCLUDED.spec""",
+                                      snapshot_rows)
+
+    def save_parses(self, characters, metric):
+        # written in the background so the command isn't held up by it or failed by a database error
+        async def save():
+            try:
+                await self.record_parses(characters, metric)
+            except Exception as e:
+                print("Ignoring exception while saving parse history:", file=sys.stderr)
+                traceback.print_exception(type(e), e, e.__traceback__, file=sys.stderr)
+
+        if characters:
+            self.bot.loop.create_task(save())
+
+    def difficulty_name(self, zone_id, diff_id):
+        return next((d.name for d in self.get_difficulties_ids_by_zone(zone_id) if d.diff_id == diff_id), diff_id)
+
+    async def show_history(self, ctx, character, encounters, zone_name):
+        # served from parse_snapshot only, nothing is fetched from fflogs
+        character = await CharacterAndWorldConverter().convert(ctx, character)
+        name = character["first_name"] + " " + character["second_name"]
+
+        rows = await ctx.db.fetch("""SELECT s.day, s.encounter_id, s.difficulty, s.metric, s.best_percent,
+                                            s.best_amount, s.total_kills, c.id
+                                     FROM parse_snapshot s INNER JOIN fflogs_character c ON c.id = s.character_id
+                                     WHERE LOWER(c.name) = $1 and LOWER(c.world) = $2
+                                     and s.encounter_id = ANY($3::SMALLINT[])
+                                     ORDER BY s.day DESC, s.encounter_id, s.difficulty, s.metric""",
+                                  name.lower(), character["world"].lower(), encounters)
+
+        if not rows:
+            raise ParsesNotFound(f"No parse history was found for the **character** \"{name}\" for world "
+                                 f"**{character['world']}**, it's saved whenever their logs are looked up.")
+
+        length = max(len(self.catalog.encounter_name(r["encounter_id"]) or "") for r in rows)
+        entries = []
+
+        for r in rows:
+            encounter = self.catalog.encounters.get(r["encounter_id"])
+            encounter_name = encounter.name if encounter else str(r["encounter_id"])
+            difficulty = self.difficulty_name(encounter.zone_id if encounter else None, r["difficulty"])
+            percentile = f"{r['best_percent']:3.0f}" if r["best_percent"] is not None else "  -"
+
+            entries.append(f"`{r['day']:%Y-%m-%d}` **`{encounter_name.ljust(length)}`** `{r['best_amount']:5.0f}` "
+                           f"{r['metric']} `{percentile}` • `{r['total_kills']}` kills **({difficulty})**\n")
+
+        embed = namedtuple("Embed", "title url zone_name")
+        url = f"https://www.fflogs.com/character/id/{rows[0]['id']}"
+        await self.paginate(ctx, entries, embed(f"{name} of {character['world']}", url, zone_name))
+
+    def build_roster_string(self, name, length, parse, total_kills, options: ParseOptions):
+        if not parse:
+            return f"**`{name.ljust(length)}`** no kills"
+
+        time = self.build_time(parse["duration"])
+        job = self.get_job_emote(parse["spec"].lower())
+        url = f"https://www.fflogs.com/reports/{parse['report']['code']}#fight={parse['report']['fightID']}"
+
+        return f"{job} **`{name.ljust(length)}`** [`{parse['amount']:5.0f}`]({url}) {options.metric} " \
+               f"`{parse['rankPercent']:3.0f}` • `{time}` • `{total_kills}` kills"
+
+    def build_roster_pages(self, roster, options: ParseOptions):
+        # a page per encounter and difficulty comparing everyone's best parse
+        comparison = {}
+        missing = []
+        length = max(len(c["first_name"]) + len(c["second_name"]) + 1 for c, _ in roster)
+
+        for character, data in roster:
+            name = character["first_name"] + " " + character["second_name"]
+
+            if not data:
+                missing.append(name)
+                continue
+
+            for key, value in data.items():
+
+                if not self.encounter_regex.match(key) or not value:
+                    continue
+
+                parses = [parse for parse in value["ranks"] if self.check_parse(parse)]
+                best = max(parses, key=lambda parse: parse["rankPercent"], default=None)
+                comparison.setdefault(key, []).append((name, best, value["totalKills"]))
+
+        pages = []
+
+        for key, rows in comparison.items():
+
+            if not any(best for _, best, _ in rows):
+                continue
+
+            rows.sort(key=lambda row: row[1]["rankPercent"] if row[1] else -1, reverse=True)
+            encounter = self.catalog.encounter_name(int(re.sub(r"[a-zA-Z]", "", key)))
+            lines = [self.build_roster_string(name, length, best, kills, options) for name, best, kills in rows]
+
+            # big rosters are spread over multiple pages to stay under the embed limits
+            for i in range(0, len(lines), 10):
+                pages.append((f"{encounter} ({self.sub_difficulty(key)})", "\n".join(lines[i:i + 10])))
+
+        return pages, missing
+
+    async def compare_roster(self, ctx, options: ParseOptions, user_ids, title):
+        characters = await ctx.db.fetch("""SELECT first_name, second_name, world_name as world, region
+                                           FROM lodestone_user WHERE user_id = ANY($1::BIGINT[])""", user_ids)
+
+        if not characters:
+            raise commands.BadArgument("None of those members have a saved character.")
+
+        async with ctx.typing():
+            difficulties = self.get_difficulties_ids_by_zone(self.current_tier_id)
+
+            if options.savage_only:
+                # 101 = savage, also keeps the query smaller
+                difficulties = [d for d in difficulties if d.diff_id == 101]
+
+            encounters = self.get_encounters_by_zone(self.current_tier_id)
+
+            roster = await self.get_roster_data(characters, difficulties, encounters, options)
+            pages, missing = self.build_roster_pages(roster, options)
+
+            if not pages:
+                raise ParsesNotFound(f"No parses were found for anyone in **{title}**.")
+
+            zone_name = self.catalog.zone_name(self.current_tier_id)
+
+        source = RosterSource(f"{title} ({zone_name})", pages, missing)
+        pages = ctx.reply_menu(source=source, clear_reactions_after=True)
+        await pages.start(ctx)
+
+    async def get_static(self, ctx, name):
+        # the name is returned as it was first saved so it's shown the same however it's typed
+        static = await ctx.db.fetchrow("SELECT id, name FROM static WHERE guild_id = $1 and LOWER(name) = $2",
+                                       ctx.guild.id, name.lower())
+
+        if not static:
+            raise commands.BadArgument(f"There's no static named `{name}` in this server.")
+
+        return static
+
     async def paginate(self, ctx, entries, embed_tuple):
         pages = ctx.reply_menu(source=ParseSource(embed_tuple, entries), clear_reactions_after=True)
         await pages.start(ctx)
@@ -276,7 +776,7 @@ class FFlogs(commands.Cog):
     async def build_embed_tuple(self, ctx, data, ranks):
         embed = namedtuple("Embed", "title url zone_name")
         zone_id = data["data"]["characterData"]["character"][ranks[0][0]]["zone"]
-        zone_name = await ctx.db.fetchval("""SELECT name from zone WHERE id = $1 """, zone_id)
+        zone_name = self.catalog.zone_name(zone_id)
         char_id = data["data"]["characterData"]["character"]["canonicalID"]
         char_name = data["data"]["characterData"]["character"]["name"]
         char_world = data["data"]["characterData"]["character"]["server"]["name"]
@@ -284,42 +784,44 @@ class FFlogs(commands.Cog):
         title = f"{char_name} of {char_world}"
         return embed(title, url, zone_name)
 
-    async def build_zone_string(self, ctx, key, parse):
-        length = await ctx.db.fetchval("SELECT LENGTH(name) FROM encounter ORDER BY LENGTH(name) desc")
+    def build_zone_string(self, key, parse, options: ParseOptions):
+        length = self.catalog.encounter_name_length
         time = self.build_time(parse["fastestKill"])
         percentile = parse["rankPercent"]
         dps = parse["bestAmount"]
+        metric = options.metric
         job = self.get_job_emote(parse["bestSpec"].lower())
         name = parse["encounter"]["name"]
         total_kills = parse["totalKills"]
         difficulty = self.sub_difficulty(key)
-        result = f"{job} **`{name.ljust(length)}`** `{dps:5.0f}` {self.metric} `{percentile:3.0f}` • `{time}` • `" \
+        result = f"{job} **`{name.ljust(length)}`** `{dps:5.0f}` {metric} `{percentile:3.0f}` • `{time}` • `" \
                  f"{total_kills}` kills **({difficulty})**\n"
 
         return result
 
-    async def build_encounter_string(self, ctx, key, parse):
-        length = await ctx.db.fetchval("SELECT LENGTH(name) FROM encounter ORDER BY LENGTH(name) desc")
+    def build_encounter_string(self, key, parse, options: ParseOptions):
+        length = self.catalog.encounter_name_length
         time = self.build_time(parse['duration'])
         percentile = parse["rankPercent"]
         dps = parse["amount"]
+        metric = options.metric
         job = self.get_job_emote(parse["spec"].lower())
         report_id = parse["report"]["code"]
         fight_id = parse["report"]["fightID"]
         # getting rid of the difficulty name
-        name = await self.get_encounter_name_by_id(ctx, int(re.sub(r"[a-zA-Z]", "", key)))
+        name = self.catalog.encounter_name(int(re.sub(r"[a-zA-Z]", "", key)))
         url = "https://www.fflogs.com/reports/"
         # getting rid of the difficulty id
         difficulty = self.sub_difficulty(key)
 
-        result = f"{job} **`{name.ljust(length)}`** [`{dps:5.0f}`]({url}{report_id}#fight={fight_id}) {self.metric} " \
+        result = f"{job} **`{name.ljust(length)}`** [`{dps:5.0f}`]({url}{report_id}#fight={fight_id}) {metric} " \
                  f"`{percentile:3.0f}` • `{time}` **({difficulty})**\n"
 
         return result
 
     async def start_menu(self, ctx, data, ranks,
-                         func: typing.Callable[[context.Context, str, dict], typing.Awaitable[str]],
-                         ranking_key):
+                         func: typing.Callable[[str, dict, ParseOptions], str],
+                         ranking_key, options: ParseOptions):
 
         embed_tuple = await self.build_embed_tuple(ctx, data, ranks)
 
@@ -328,98 +830,125 @@ class FFlogs(commands.Cog):
         # build zone string/build encounter string
         # unpacking ranks as I iterate over it then iterating over another list accessed from the value dictionary
         # checking for parses that pass the conditional to build the zone/encounter string
-        entries = [await func(ctx, key, parse)
+        entries = [func(key, parse, options)
                    for key, value in ranks for parse in value[ranking_key]
                    if self.check_parse(parse)]
 
         await self.paginate(ctx, entries, embed_tuple)
 
-    async def get_close_matches(self, ctx, name, data: Record) -> None:
-        words = difflib.get_close_matches(name, (e["name"] for e in data))
+    @staticmethod
+    async def get_close_matches(ctx, name, words: typing.List[str]) -> None:
 
         if words:
-            # drop duplicates
-            words = list(dict.fromkeys(words))
             await ctx.send(f"> Search failed for \"{name}\"\n> Did you mean.... \n> {', '.join(words)}?")
 
         else:
 
             await ctx.send(f"> search failed for \"{name}\"")
 
-    async def best_encounter(self, ctx, data, ranks) -> None:
+    async def best_encounter(self, ctx, data, ranks, options: ParseOptions) -> None:
         entries = []
         embed_tuple = await self.build_embed_tuple(ctx, data, ranks)
         for t in ranks:
             key, val = t
             total_kills = val["totalKills"]
-            string = await self.build_encounter_string(ctx, key, val["ranks"][0])
+            string = self.build_encounter_string(key, val["ranks"][0], options)
             difficulty = self.sub_difficulty(key)
             string = string.replace(f"**({difficulty})**", f"`{total_kills}` kills **({difficulty})**\n")
             entries.append(string)
 
         await self.paginate(ctx, entries, embed_tuple)
 
-    async def get_encounter_logs(self, ctx, savage_only: typing.Optional[bool],
-                                 name, character: typing.Optional[typing.Union[discord.User, str]] = None,
-                                 best=False):
-        encounter = await ctx.db.fetchval("""SELECT id FROM encounter
-                                             WHERE lower(name) LIKE $1 or LOWER(alias_s)
-                                             LIKE $1 or LOWER(alias_n) LIKE $1""",
-                                          name.lower() + "%")
+    async def get_encounter_logs(self, ctx, name, character: typing.Optional[typing.Union[discord.User, str]],
+                                 options: ParseOptions, best=False):
+        encounter = self.catalog.find_encounter(name)
+
         if not encounter:
-            return await self.get_close_matches(ctx, name, await ctx.db.fetch("SELECT name FROM encounter"))
+            return await self.get_close_matches(ctx, name, self.catalog.similar_encounters(name))
 
         # dungeons and alliance raid encounters only accept dps as a metric
         if encounter > 2000:
-            self.metric = "dps"
+            options = options._replace(metric="dps")
 
         character = await CharacterAndWorldConverter().convert(ctx, character)
         async with ctx.typing():
-            region = await ctx.db.fetchval("SELECT region from world where name like $1", character["world"])
-            # full join then a inner join, yeah don't ask
-            difficulties = await ctx.db.fetch("""SELECT d.name, diff_id FROM difficulties d, encounter e
-                                                 INNER JOIN zone z ON e.zone_id  = z.id
-                                                 WHERE e.id = $1 and z.id = d.zone_id """, encounter)
-
-            data, ranks = await self.get_character_data(character, region, difficulties, encounters=[encounter])
+            region = self.catalog.region(character["world"])
+            difficulties = self.get_difficulties_ids_by_zone(self.catalog.encounters[encounter].zone_id)
 
-            if savage_only:
-                self.savage_only(ranks, character)
+            data, ranks = await self.get_character_data(character, region, difficulties, options,
+                                                        encounters=[encounter])
 
             if best:
-                return await self.best_encounter(ctx, data, ranks)
+                return await self.best_encounter(ctx, data, ranks, options)
+
+            await self.start_menu(ctx, data, ranks, self.build_encounter_string, "ranks", options)
+
+    async def best_tier_logs(self, ctx, character, options: ParseOptions):
+        character = await CharacterAndWorldConverter().convert(ctx, character)
+
+        region = self.catalog.region(character["world"])
+
+        difficulties = self.get_difficulties_ids_by_zone(self.current_tier_id)
+
+        data, ranks = await self.get_character_data(character, region, difficulties, options,
+                                                    zones=[self.current_tier_id])
+
+        await self.start_menu(ctx, data, ranks, self.build_zone_string, "rankings", options)
 
-            await self.start_menu(ctx, data, ranks, self.build_encounter_string, "ranks")
+    async def best_zone_logs(self, ctx, name, character, options: ParseOptions):
+        character = await CharacterAndWorldConverter().convert(ctx, character)
+
+        region = self.catalog.region(character["world"])
+        zone = self.get_zone(name)
+
+        if not zone:
+            return await self.get_close_matches(ctx, name, self.catalog.similar_zones(name))
+
+        check = self.get_encounters_by_zone(zone)
+
+        if check and check[0] > 2000:
+            # dungeons and alliance raid encounters only accept dps as a metric
+            options = options._replace(metric="dps")
+
+        difficulties = self.get_difficulties_ids_by_zone(zone)
+
+        data, ranks = await self.get_character_data(character, region, difficulties, options, zones=[zone])
+
+        await self.start_menu(ctx, data, ranks, self.build_zone_string, "rankings", options)
 
     @commands.group(invoke_without_command=True, aliases=["tl"])
-    async def tierlogs(self, ctx, savage_only: typing.Optional[bool], *,
+    async def tierlogs(self, ctx, refresh: typing.Optional[RefreshConverter],
+                       savage_only: typing.Optional[bool], *,
                        character: typing.Optional[typing.Union[discord.User, str]] = None):
         """Displays raid parses with a hyperlink for the current expansion raid tier
            If you don't provide a Discord user or character parameters, your own saved character will be used.
            The savage_only parameter takes arguments like yes/no
+           Parses are cached for a few minutes, saved characters' parses are fetched ahead of time off-peak and
+           kept for up to six hours, passing refresh first fetches them again
            -------------------------------------------------------------
            tataru tierlogs
            tataru tierlogs y
+           tataru tierlogs refresh
            tataru tierlogs @User or user_id or name
            tataru tierlogs World Forename Surname"""
 
         character = await CharacterAndWorldConverter().convert(ctx, character)
         async with ctx.typing():
-            region = await ctx.db.fetchval("SELECT region from world where name like $1", character["world"])
-
-            difficulties = await self.get_difficulties_ids_by_zone(ctx, self.current_tier_id)
+            region = self.catalog.region(character["world"])
 
-            encounters = [res["id"] for res in await self.get_encounters_by_zone(ctx, self.current_tier_id)]
+            difficulties = self.get_difficulties_ids_by_zone(self.current_tier_id)
 
-            data, ranks = await self.get_character_data(character, region, difficulties, encounters=encounters)
+            encounters = self.get_encounters_by_zone(self.current_tier_id)
+            options = ParseOptions(savage_only=bool(savage_only), refresh=bool(refresh))
 
-            if savage_only:
-                self.savage_only(ranks, character)
+            data, ranks = await self.get_character_data(character, region, difficulties, options,
+                                                        encounters=encounters)
 
-            await self.start_menu(ctx, data, ranks, self.build_encounter_string, "ranks")
+            await self.start_menu(ctx, data, ranks, self.build_encounter_string, "ranks", options)
 
     @tierlogs.group(aliases=["b"], invoke_without_command=True)
-    async def best(self, ctx, savage_only: typing.Optional[bool], *,
+    async def best(self, ctx, refresh: typing.Optional[RefreshConverter],
+                   savage_only: typing.Optional[bool], *,
                    character: typing.Optional[typing.Union[discord.User, str]] = None):
         """Displays best raid parses
            The savage_only parameter takes arguments like yes/no
@@ -429,22 +958,111 @@ class FFlogs(commands.Cog):
            tataru tierlogs best @User or user_id or name
            tataru tierlogs best World Forename Surname
         """
+        await self.best_tier_logs(ctx, character, ParseOptions(savage_only=bool(savage_only), refresh=bool(refresh)))
+
+    @tierlogs.command(aliases=["r"])
+    @commands.guild_only()
+    async def roster(self, ctx, savage_only: typing.Optional[bool],
+                     *members: typing.Union[discord.Role, discord.Member]):
+        """Compares the best raid parses of a group of members for the current raid tier
+           Roles include everyone in them, only members with a saved character are compared.
+           The savage_only parameter takes arguments like yes/no
+           -------------------------------------------------------------
+           tataru tierlogs roster @Role
+           tataru tierlogs roster y @Role
+           tataru tierlogs roster @User @User2 @User3
+        """
+        if not members:
+            raise commands.BadArgument("A role or members need to be passed.")
 
-        character = await CharacterAndWorldConverter().convert(ctx, character)
+        user_ids = set()
+        for member in members:
+            if isinstance(member, discord.Role):
+                user_ids.update(m.id for m in member.members)
+            else:
+                user_ids.add(member.id)
 
-        region = await ctx.db.fetchval("SELECT region from world where name like $1", character["world"])
+        await self.compare_roster(ctx, ParseOptions(savage_only=bool(savage_only)), list(user_ids), ctx.guild.name)
 
-        difficulties = await self.get_difficulties_ids_by_zone(ctx, self.current_tier_id)
+    @tierlogs.command(name="history", aliases=["h"])
+    async def tier_history(self, ctx, *, character: typing.Optional[typing.Union[discord.User, str]] = None):
+        """Displays how best parses and kill counts for the current raid tier changed day by day
+           History is saved whenever a character's logs are looked up.
+           -------------------------------------------------------------
+           tataru tierlogs history
+           tataru tierlogs history @User or user_id or name
+           tataru tierlogs history World Forename Surname
+        """
+        await self.show_history(ctx, character, self.get_encounters_by_zone(self.current_tier_id),
+                                self.catalog.zone_name(self.current_tier_id))
 
-        data, ranks = await self.get_character_data(character, region, difficulties, zones=[self.current_tier_id])
+    @tierlogs.group(invoke_without_command=True)
+    @commands.guild_only()
+    async def static(self, ctx, savage_only: typing.Optional[bool], *, name):
+        """Compares the best raid parses of a static saved for this server for the current raid tier
+           The savage_only parameter takes arguments like yes/no
+           -------------------------------------------------------------
+           tataru tierlogs static name
+           tataru tierlogs static y name
+        """
+        static = await self.get_static(ctx, name)
+        members = await ctx.db.fetch("SELECT user_id FROM static_member WHERE static_id = $1", static["id"])
 
-        if savage_only:
-            self.savage_only(ranks, character)
+        await self.compare_roster(ctx, ParseOptions(savage_only=bool(savage_only)), [m["user_id"] for m in members],
+                                  static["name"])
 
-        await self.start_menu(ctx, data, ranks, self.build_zone_string, "rankings")
+    @static.command(name="add")
+    @commands.guild_only()
+    @commands.has_permissions(manage_guild=True)
+    async def static_add(self, ctx, name, *members: discord.Member):
+        """Adds members with a saved character to a static, creating it if it doesn't exist
+           -------------------------------------------------------------
+           tataru tierlogs static add name @User @User2
+        """
+        async with ctx.acquire():
+            static = await ctx.db.fetchrow("""INSERT INTO static (guild_id, name) VALUES ($1, $2)
+                                              ON CONFLICT (guild_id, LOWER(name)) DO UPDATE SET name = static.name
+                                              RETURNING id, name""", ctx.guild.id, name)
+
+            check = await ctx.db.execute("""INSERT INTO static_member (static_id, user_id)
+                                            SELECT $1, user_id FROM lodestone_user WHERE user_id = ANY($2::BIGINT[])
+                                            ON CONFLICT DO NOTHING""", static["id"], [m.id for m in members])
+
+        await ctx.send(f"> Added {check.split()[-1]} member(s) to `{static['name']}` :white_check_mark:.")
+
+    @static.command(name="remove")
+    @commands.guild_only()
+    @commands.has_permissions(manage_guild=True)
+    async def static_remove(self, ctx, name, *members: discord.Member):
+        """Removes members from a static
+           -------------------------------------------------------------
+           tataru tierlogs static remove name @User @User2
+        """
+        async with ctx.acquire():
+            static = await self.get_static(ctx, name)
+            check = await ctx.db.execute("""DELETE FROM static_member
+                                            WHERE static_id = $1 and user_id = ANY($2::BIGINT[])""",
+                                         static["id"], [m.id for m in members])
+
+        await ctx.send(f"> Removed {check.split()[-1]} member(s) from `{static['name']}` :white_check_mark:.")
+
+    @static.command(name="delete")
+    @commands.guild_only()
+    @commands.has_permissions(manage_guild=True)
+    async def static_delete(self, ctx, *, name):
+        """Deletes a static
+           -------------------------------------------------------------
+           tataru tierlogs static delete name
+        """
+        async with ctx.acquire():
+            static = await self.get_static(ctx, name)
+            await ctx.db.execute("DELETE FROM static WHERE id = $1", static["id"])
+
+        await ctx.send(f"> Deleted `{static['name']}` :white_check_mark:.")
 
     @best.command(name="adps")
-    async def actual_dps(self, ctx, savage_only: typing.Optional[bool], *,
+    async def actual_dps(self, ctx, refresh: typing.Optional[RefreshConverter],
+                         savage_only: typing.Optional[bool], *,
                          character: typing.Optional[typing.Union[discord.User, str]] = None):
         """sets the metric for rankings to adps
            The savage_only parameter takes arguments like yes/no
@@ -454,46 +1072,50 @@ class FFlogs(commands.Cog):
            tataru tierlogs best adps @User or user_id or name
            tataru tierlogs best adps World Forename Surname
            """
-        await self.invoke_best(ctx, "tierlogs best", savage_only=savage_only, character=character)
+        await self.best_tier_logs(ctx, character, ParseOptions("dps", bool(savage_only), bool(refresh)))
 
     @commands.group(aliases=["log", "l"], invoke_without_command=True)
-    async def logs(self, ctx, savage_only: typing.Optional[bool], name, *,
+    async def logs(self, ctx, refresh: typing.Optional[RefreshConverter],
+                   savage_only: typing.Optional[bool], name, *,
                    character: typing.Optional[typing.Union[discord.User, str]] = None):
         """returns all parses for a zone by name as found on fflogs
            If you don't provide a Discord user or character parameters, your own saved character will be used.
            The savage_only parameter takes arguments like yes/no
+           Parses are cached for a few minutes, passing refresh first fetches them again
            -------------------------------------------------------------
            tataru logs "Eden's Promise"
            tataru logs y "Eden's Promise"
+           tataru logs refresh "Eden's Promise"
            tataru logs "Eden's Promise" @User or user_id or name
            tataru logs "Eden's Promise" World Forename Surname
         """
 
         character = await CharacterAndWorldConverter().convert(ctx, character)
         async with ctx.typing():
-            region = await ctx.db.fetchval("SELECT region from world where name like $1", character["world"])
-            zone = await self.get_zone(ctx, name.lower() + "%")
+            region = self.catalog.region(character["world"])
+            zone = self.get_zone(name)
 
             if not zone:
-                return await self.get_close_matches(ctx, name, await ctx.db.fetch("SELECT name FROM zone"))
+                return await self.get_close_matches(ctx, name, self.catalog.similar_zones(name))
+
+            difficulties = self.get_difficulties_ids_by_zone(zone)
 
-            difficulties = await self.get_difficulties_ids_by_zone(ctx, zone)
+            encounters = self.get_encounters_by_zone(zone)
 
-            encounters = [res["id"] for res in await self.get_encounters_by_zone(ctx, zone)]
+            options = ParseOptions(savage_only=bool(savage_only), refresh=bool(refresh))
 
             if any(e > 2000 for e in encounters):
                 # dungeons and alliance raid encounters only accept dps as a metric
-                self.metric = "dps"
+                options = options._replace(metric="dps")
 
-            data, ranks = await self.get_character_data(character, region, difficulties, encounters=encounters)
+            data, ranks = await self.get_character_data(character, region, difficulties, options,
+                                                        encounters=encounters)
 
-            if savage_only:
-                self.savage_only(ranks, character)
-
-            await self.start_menu(ctx, data, ranks, self.build_encounter_string, "ranks")
+            await self.start_menu(ctx, data, ranks, self.build_encounter_string, "ranks", options)
 
     @logs.group(aliases=["b"], name="best", invoke_without_command=True)
-    async def best_logs(self, ctx, savage_only: typing.Optional[bool], name, *,
+    async def best_logs(self, ctx, refresh: typing.Optional[RefreshConverter],
+                        savage_only: typing.Optional[bool], name, *,
                         character: typing.Optional[typing.Union[discord.User, str]] = None):
         """Displays best parses
            The savage_only parameter takes arguments like yes/no
@@ -503,29 +1125,12 @@ class FFlogs(commands.Cog):
            tataru logs best @User or user_id or name "Eden's Promise"
            tataru logs best World Forename Surname "Eden's Promise"
         """
-        character = await CharacterAndWorldConverter().convert(ctx, character)
-
-        region = await ctx.db.fetchval("SELECT region from world where name like $1", character["world"])
-        zone = await self.get_zone(ctx, name.lower() + "%")
-
-        if not zone:
-            return await self.get_close_matches(ctx, name, await ctx.db.fetch("SELECT name FROM zone"))
-
-        check = await ctx.db.fetchval("SELECT id FROM encounter WHERE zone_id = $1", zone)
-
-        if check > 2000:
-            self.metric = "dps"
-        difficulties = await self.get_difficulties_ids_by_zone(ctx, zone)
-
-        data, ranks = await self.get_character_data(character, region, difficulties, zones=[zone])
-
-        if savage_only:
-            self.savage_only(ranks, character)
-
-        await self.start_menu(ctx, data, ranks, self.build_zone_string, "rankings")
+        await self.best_zone_logs(ctx, name, character,
+                                  ParseOptions(savage_only=bool(savage_only), refresh=bool(refresh)))
 
     @best_logs.command(name="adps")
-    async def best_logs_adps(self, ctx, savage_only: typing.Optional[bool], zone, *,
+    async def best_logs_adps(self, ctx, refresh: typing.Optional[RefreshConverter],
+                             savage_only: typing.Optional[bool], zone, *,
                              character: typing.Optional[typing.Union[discord.User, str]] = None):
         """sets the metric for rankings to adps
            The savage_only parameter takes arguments like yes/no
@@ -536,26 +1141,48 @@ class FFlogs(commands.Cog):
            tataru logs best adps World Forename Surname
            """
 
-        await self.invoke_best(ctx, "logs best", savage_only, zone, character=character)
+        await self.best_zone_logs(ctx, zone, character, ParseOptions("dps", bool(savage_only), bool(refresh)))
 
     @commands.group(aliases=["encounter", "el"], invoke_without_command=True)
-    async def encounterlogs(self, ctx, savage_only: typing.Optional[bool],
+    async def encounterlogs(self, ctx, refresh: typing.Optional[RefreshConverter],
+                            savage_only: typing.Optional[bool],
                             name, *, character: typing.Optional[typing.Union[discord.User, str]] = None):
         """returns all parses for an encounter by name as found on fflogs
            If you don't provide a Discord user or character parameters, your own saved character will be used.
            encounter acronyms are also accepted valid ones are (e1-x,o1-x,a1-x)
            eg. tataru e6s or tataru e6n or tataru e6, with a savage check
            The savage_only parameter takes arguments like yes/no
+           Parses are cached for a few minutes, passing refresh first fetches them again
            -------------------------------------------------------------
            tataru el "encounter name"
            tataru el y "encounter name"
+           tataru el refresh "encounter name"
            tataru el "encounter name" @User or user_id or name
            tataru el "encounter name" World Forename Surname
         """
-        await self.get_encounter_logs(ctx, savage_only, name, character)
+        await self.get_encounter_logs(ctx, name, character,
+                                      ParseOptions(savage_only=bool(savage_only), refresh=bool(refresh)))
+
+    @encounterlogs.command(name="history", aliases=["h"])
+    async def encounter_history(self, ctx, name, *,
+                                character: typing.Optional[typing.Union[discord.User, str]] = None):
+        """Displays how best parses and kill counts for an encounter changed day by day
+           History is saved whenever a character's logs are looked up.
+           -------------------------------------------------------------
+           tataru el history "Cloud of Darkness"
+           tataru el history "Cloud of Darkness" @User or user_id or name
+           tataru el history "Cloud of Darkness" World Forename Surname
+        """
+        encounter = self.catalog.find_encounter(name)
+
+        if not encounter:
+            return await self.get_close_matches(ctx, name, self.catalog.similar_encounters(name))
+
+        await self.show_history(ctx, character, [encounter], self.catalog.encounter_name(encounter))
 
     @encounterlogs.group(name="best", aliases=["b"], invoke_without_command=True)
-    async def best_encounter_logs(self, ctx, savage_only: typing.Optional[bool],
+    async def best_encounter_logs(self, ctx, refresh: typing.Optional[RefreshConverter],
+                                  savage_only: typing.Optional[bool],
                                   name, *, character: typing.Optional[typing.Union[discord.User, str]] = None):
         """Displays best encounter parse
            The savage_only parameter takes arguments like yes/no
@@ -565,10 +1192,12 @@ class FFlogs(commands.Cog):
            tataru el best @User or user_id or name "Cloud of Darkness"
            tataru el best World Forename Surname "Cloud of Darkness"
         """
-        await self.get_encounter_logs(ctx, savage_only, name, character, True)
+        await self.get_encounter_logs(ctx, name, character,
+                                      ParseOptions(savage_only=bool(savage_only), refresh=bool(refresh)), best=True)
 
     @best_encounter_logs.command(name="adps")
-    async def best_encounter_adps(self, ctx, savage_only: typing.Optional[bool],
+    async def best_encounter_adps(self, ctx, refresh: typing.Optional[RefreshConverter],
+                                  savage_only: typing.Optional[bool],
                                   name, *, character: typing.Optional[typing.Union[discord.User, str]] = None):
         """sets the metric for rankings to adps
            The savage_only parameter takes arguments like yes/no
@@ -578,7 +1207,8 @@ class FFlogs(commands.Cog):
            tataru el best adps @User or user_id or name "Cloud of Darkness"
            tataru el best adps World Forename Surname "Cloud of Darkness"
         """
-        await self.invoke_best(ctx, "encounterlogs best", savage_only, name, character=character)
+        await self.get_encounter_logs(ctx, name, character, ParseOptions("dps", bool(savage_only), bool(refresh)),
+                                      best=True)
 
     @commands.is_owner()
     @commands.command(aliases=["scz"])
@@ -587,9 +1217,7 @@ class FFlogs(commands.Cog):
         set the current raid zone for the fflogs cog
         """
 
-        check = await ctx.db.fetchval("SELECT * FROM zone where id = $1", zone_id)
-
-        if not check:
+        if zone_id not in self.catalog.zones:
             return await ctx.send(f"> A zone with id {zone_id}, does not exist.")
 
         self.current_tier_id = zone_id
@@ -625,13 +1253,7 @@ class FFlogs(commands.Cog):
                }      
         """
         async with ctx.typing():
-            token = await self.api.get_bearer_token()
-            headers = {
-                "Content-Type": "application/json",
-                "Authorization": f"Bearer {token['access_token']}"
-            }
-
-            data = await self.api.client.execute_async(query=query, headers=headers)
+            data = await self.api.call_fflogs_api(query=query, priority=Priority.background, shed=True)
 
             for expansion in data["data"]["worldData"]["expansions"]:
                 for zone in expansion["zones"]:
@@ -666,6 +1288,7 @@ class FFlogs(commands.Cog):
                                                     SET id = $1, name = $2, expansion_name = $3, zone_id = $4""",
                                                  encounter["id"], encounter["name"], expansion_name, zone["id"])
 
+            await self.reload_catalog(ctx)
             await ctx.send("successfully added/updated zones and encounters :white_check_mark:")
 
     @commands.command()
@@ -676,18 +1299,13 @@ class FFlogs(commands.Cog):
         tataru search term
         """
         params = {"term": term}
-        results = await self.bot.fetch("https://www.fflogs.com/search", params=params)
-        soup = BeautifulSoup(results, "html.parser")
-        results = soup.find("div", {"class": "result-list"})
-        entries = []
+        results = await self.bot.fetch("https://www.fflogs.com/search", params=params, conditional=True)
+        results = await FFlogsSearchPage.scrape(results)
+
         if not results:
             return await ctx.send(f"> Search failed for {term}")
 
-        worlds = results.find_all("div", {"class": "server"})
-        for i, a in enumerate(results.find_all("a")):
-            world = worlds[i].get_text()
-            result = f"[{a.get_text()}]({a.get('href')}) of {world}"
-            entries.append(result)
+        entries = [f"[{result.name}]({result.url}) of {result.world}" for result in results]
 
         pages = ctx.menu(source=SearchSource(entries), clear_reactions_after=True)
         await pages.start(ctx)
@@ -725,6 +1343,7 @@ class FFlogs(commands.Cog):
             if check == "UPDATE 0":
                 return await ctx.send("> update failed")
 
+            await self.reload_catalog(ctx)
             await ctx.send(check)
 
     @set_alias.command(aliases=["ult"])
@@ -752,13 +1371,31 @@ class FFlogs(commands.Cog):
             if check == "UPDATE 0":
                 return await ctx.send("> update failed")
 
+            await self.reload_catalog(ctx)
             await ctx.send(check)
 
+    @commands.is_owner()
+    @commands.command(aliases=["budget"])
+    async def fflogs_budget(self, ctx):
+        """Shows how much of the fflogs hourly point limit has been spent"""
+        budget = self.api.budget
+        remaining = budget.remaining
+
+        if remaining is None:
+            return await ctx.send("> No fflogs queries have been made yet.")
+
+        last_pass = f"{self.last_warmed:%Y-%m-%d %H:%M} UTC" if self.last_warmed else "never"
+
+        await ctx.send(f"> `{budget.spent:.0f}/{budget.limit}` points spent "
+                       f"({budget.spent / budget.limit:.0%}), resets in `{budget.resets_in / 60:.0f}` minutes\n"
+                       f"> background queries queued `{budget.queued}` • shed `{budget.shed}` • "
+                       f"commands refused `{budget.refused}`\n"
+                       f"> characters warmed `{self.warmed}` • last warming pass `{last_pass}`")
+
     @commands.is_owner()
     @commands.command(aliases=["swd"])
     async def setup_worlds_dc(self, ctx):
         """Adds data centers and their respective worlds to the database"""
-        token = await self.api.get_bearer_token()
         query = """
                 query {
                   worldData{
@@ -775,8 +1412,8 @@ class FFlogs(commands.Cog):
                 
                 }
         """
-        data_centres = await self.bot.fetch("https://xivapi.com/servers/dc")
-        data = await self.api.call_fflogs_api(query=query, variables="", token=token)
+        data_centres = await self.bot.fetch("https://xivapi.com/servers/dc", conditional=True)
+        data = await self.api.call_fflogs_api(query=query, priority=Priority.background, shed=True)
         data = data["data"]["worldData"]["regions"]
         # dumb way to do this but doesn't really matter
         async with ctx.acquire():
@@ -795,6 +1432,8 @@ class FFlogs(commands.Cog):
                         "INSERT INTO world (name, region, dc_name) values ($1,$2,$3) ON CONFLICT DO NOTHING", world,
                         cm, dc)
 
+            await self.reload_catalog(ctx)
+
         await ctx.reply("Finished.")
 
 
@@ -22,6 +22,9 @@ from config.utils.requests import RequestFailed
 from config.utils.cache import cache
 from config import config
 
+# downloads past this size are cut off, gear renders are nowhere near it
+MAX_IMAGE_SIZE = 20 * 1024 * 1024
+
 
 class GamerScape(commands.Cog):
     """
@@ -219,9 +222,7 @@ class GamerScape(commands.Cog):
         try:
 
             print(f"downloading ... {url}\nCategory: {category}\nKind: {kind}\nPath: {path}")
-            image_bytes = await self.bot.fetch(url)
-            with open(path, "wb") as f:
-                f.write(image_bytes)
+            await self.bot.download(url, path, max_size=MAX_IMAGE_SIZE)
 
         except RequestFailed:
             pass
@@ -315,7 +316,7 @@ class GamerScape(commands.Cog):
 
         entries = []
 
-        js = await ctx.bot.fetch(self.url, params=params)
+        js = await ctx.bot.fetch(self.url, params=params, conditional=True)
 
         for js in js["query"]["allimages"]:
 
@@ -364,7 +365,7 @@ class GamerScape(commands.Cog):
 
         }
 
-        results = await self.bot.fetch(self.url, params=params)
+        results = await self.bot.fetch(self.url, params=params, conditional=True)
 
         entries = [result["name"] for result in results["query"]["allimages"]
                    if item.lower() in result["name"].lower()]
@@ -384,9 +385,7 @@ class GamerScape(commands.Cog):
             return await ctx.send("Invalid url.")
 
         try:
-            res = await self.bot.fetch(url)
-            with open(path + "\\" + filename, "wb") as f:
-                f.write(res)
+            await self.bot.download(url, path + "\\" + filename, max_size=MAX_IMAGE_SIZE)
             await ctx.send("Successfully downloaded file.")
         except (RequestFailed, FileNotFoundError) as e:
             if isinstance(e, RequestFailed):
@@ -440,7 +439,7 @@ class GamerScape(commands.Cog):
             }
 
         while aicontinue:
-            results = await self.bot.fetch(self.url, params=params)
+            results = await self.bot.fetch(self.url, params=params, conditional=True)
 
             try:
                 await asyncio.sleep(delay)
@@ -3,12 +3,17 @@ import typing
 
 import discord
 from discord.ext import commands
-from bs4 import BeautifulSoup
 from pyxivapi import exceptions
 
 from config.utils.converters import CharacterAndWorldConverter
-from config.utils.cache import cache, Strategy
+from config.utils.cache import cache, Strategy, PostgresBackend
 from config.utils.requests import RequestFailed
+from config.utils.scraping import LodestoneCharacterPage
+
+
+def character_key(_, character):
+    # characters come in as either a converter dict or a lodestone_user record
+    return character["world"].lower(), character["first_name"].lower(), character["second_name"].lower()
 
 
 class LodeStone(commands.Cog):
@@ -18,12 +23,19 @@ class LodeStone(commands.Cog):
 
     async def add_character(self, ctx, avatar_url, data: typing.Tuple):
 
+        previous = await ctx.db.fetchrow("""SELECT first_name, second_name, world_name as world
+                                            FROM lodestone_user WHERE user_id = $1""", data[0])
+
         await ctx.db.execute("""
             INSERT INTO lodestone_user (user_id, first_name, second_name, world_name, region, lodestone_id) 
             VALUES ($1,$2,$3,$4,$5,$6) ON CONFLICT (user_id) 
             DO UPDATE SET (first_name, second_name, world_name, region, lodestone_id) = ($2,$3,$4,$5,$6)
             """, *data)
 
+        # lets cogs drop anything they've cached for the old and new character
+        self.bot.dispatch("character_update", previous, {"first_name": data[1], "second_name": data[2],
+                                                         "world": data[3]})
+
         name = f"{data[1]} {data[2]}"
 
         embed = discord.Embed(title=f"Character successfully saved",
@@ -32,7 +44,8 @@ class LodeStone(commands.Cog):
         embed.set_author(name=name, icon_url=avatar_url)
         await ctx.send(embed=embed)
 
-    @cache(maxsize=60, strategy=Strategy.timed)
+    @cache(maxsize=512, strategy=Strategy.swr, ttl=3600, hard_ttl=86400, key=character_key,
+           negative_ttl=300, backend=PostgresBackend())
     async def get_extended_results(self, character):
         url = None
         world = character["world"]
@@ -59,9 +72,9 @@ class LodeStone(commands.Cog):
         except exceptions.XIVAPIError:
             # fallback to scraping if XIVAPI is having issues
             if lod_id:
-                response = await self.bot.fetch(f"https://eu.finalfantasyxiv.com/lodestone/character/{lod_id}")
-                soup = BeautifulSoup(response, "html.parser")
-                url = soup.find("div", class_="character__detail__image").find("img")["src"]
+                response = await self.bot.fetch(f"https://eu.finalfantasyxiv.com/lodestone/character/{lod_id}",
+                                                conditional=True)
+                url = (await LodestoneCharacterPage.scrape(response)).portrait
 
         return url
 
@@ -76,12 +89,12 @@ class LodeStone(commands.Cog):
         await ctx.trigger_typing()
 
         async with ctx.acquire():
-            data = await ctx.db.fetchrow("SELECT * from world where LOWER(name) like $1", world.lower())
+            data = self.bot.catalog.world(world)
 
             if not data:
                 return await ctx.send("Invalid world was passed.")
 
-            world = data["name"]
+            world = data.name
 
             results = await self.bot.pyxivapi.character_search(world=world, forename=forename, surname=surname)
 
@@ -91,7 +104,7 @@ class LodeStone(commands.Cog):
             character_id = results["Results"][0]["ID"]
             results = await self.bot.pyxivapi.character_by_id(lodestone_id=character_id, extended=True)
             await self.add_character(ctx, results["Character"]["Avatar"],
-                                     (ctx.author.id, forename, surname, data["name"], data["region"], character_id))
+                                     (ctx.author.id, forename, surname, data.name, data.region, character_id))
 
     @iam.error
     async def iam_error(self, ctx, error):
@@ -119,19 +132,16 @@ class LodeStone(commands.Cog):
         lodestone_id = int(match.group(2))
 
         try:
-            response = await self.bot.fetch(lodestone_url)
+            response = await self.bot.fetch(lodestone_url, conditional=True)
         except RequestFailed as e:
             return await ctx.send(f":no_entry: | {e}")
 
-        soup = BeautifulSoup(response, "html.parser")
-
-        forename, surname = soup.find("p", class_="frame__chara__name").text.split(" ")
-        world = soup.find("p", class_="frame__chara__world").text.split(" ")[0]
+        character = await LodestoneCharacterPage.scrape(response)
 
-        region = await ctx.db.fetchval("SELECT region FROM world WHERE name like $1", world)
-        avatar = soup.find("div", class_="frame__chara__face").find("img")["src"]
+        region = self.bot.catalog.region(character.world)
 
-        await self.add_character(ctx, avatar, (ctx.author.id, forename, surname, world, region, lodestone_id))
+        await self.add_character(ctx, character.avatar, (ctx.author.id, character.forename, character.surname,
+                                                         character.world, region, lodestone_id))
 
     @commands.command(aliases=["por"])
     async def portrait(self, ctx, *, character: typing.Union[discord.User, str] = None):
@@ -148,7 +158,6 @@ class LodeStone(commands.Cog):
             url = await self.get_extended_results(character)
 
             if not url:
-                self.get_extended_results.invalidate(character)
                 return await ctx.send("> Couldn't find that character's portrait.")
 
             await ctx.send(url)
@@ -4,28 +4,21 @@ import asyncio
 import discord
 from discord.ext import commands, flags, menus
 
-from bs4 import BeautifulSoup
-
 from cog_menus.pages_sources import MirapiSource
 from cog_menus import menus as base
-from config.utils.cache import cache, Strategy
+from config import config
+from config.utils.cache import cache, Strategy, DiskBackend
+from config.utils.scraping import MirapriGalleryPage
 from config.utils.converters import RaceConverter, JobConverter, GenderConverter
 
 
-def get_links(soup):
-    links = []
-    for link in soup.find_all("a"):
-        links.append((link.get("href"), link.img.get("alt"), link.img.get("src")))
-    return links
-
-
-@cache(maxsize=10, strategy=Strategy.timed)
+@cache(maxsize=256, strategy=Strategy.swr, ttl=600, hard_ttl=3600, max_bytes=4 * 1024 * 1024,
+       ignore=("request_func",), backend=DiskBackend(config.CACHE_ROOT))
 # outside function to make caching easier
 # passing the request function to continue sharing the current aiohttp session
-async def get_soup(url, params, request_func):
+async def get_gallery(url, params, request_func):
     results = await request_func(url, params=params)
-    soup = BeautifulSoup(results, "html.parser")
-    return soup
+    return await MirapriGalleryPage.scrape(results)
 
 
 class MirapiMenuPages(base.BaseMenu):
@@ -76,10 +69,13 @@ class MirapiMenuPages(base.BaseMenu):
 
         params[1]["page"] = self.page
 
-        soup = await get_soup(url, url_params, self.ctx.bot.fetch)
-        soup = soup.find("div", {"id": "gallery"})
+        # copied since the source keeps changing the page on the same dict
+        gallery = await get_gallery(url, dict(url_params), self.ctx.bot.fetch)
+
+        if gallery is None:
+            return self.source
 
-        source = MirapiSource(get_links(soup), params, max_pages)
+        source = MirapiSource(gallery.links, params, max_pages)
         return source
 
     @menus.button("⏫", position=menus.Last(3), lock=False)
@@ -166,7 +162,8 @@ class Mirapi(commands.Cog):
             elif k == "j":
                 options[k] = await JobConverter().convert(ctx, options[k])
 
-    @cache()
+    # item names only change between patches so these are kept on disk for a week, misses for 5 minutes
+    @cache(ignore=("self",), ttl=604800, negative_ttl=300, backend=DiskBackend(config.CACHE_ROOT))
     async def index_search_item(self, name, language=""):
 
         js = await self.bot.pyxivapi.index_search(
@@ -185,14 +182,12 @@ class Mirapi(commands.Cog):
         params = options
 
         async with ctx.typing():
-            soup = await get_soup(self.url, params, ctx.bot.fetch)
+            gallery = await get_gallery(self.url, dict(params), ctx.bot.fetch)
 
-        if soup.find("img", {"alt": "Nopost"}):
+        if gallery is None:
             raise commands.BadArgument(f"search failed for `{options['keyword']}`")
 
-        max_pages = len(soup.find("ul", {"id": "pager-wrap"}).find_all("li"))
-        soup = soup.find("div", {"id": "gallery"})
-        pages = MirapiMenuPages(source=MirapiSource(get_links(soup), (self.url, params), max_pages),
+        pages = MirapiMenuPages(source=MirapiSource(gallery.links, (self.url, params), gallery.max_pages),
                                 clear_reactions_after=True)
         await pages.start(ctx)
 
@@ -1,9 +1,18 @@
+import os
+import sys
 import enum
-import copy
+import time
+import heapq
+import pickle
 import asyncio
+import hashlib
+import inspect
+import weakref
+import itertools
+
+from functools import wraps, partial
+import asyncpg
 
-from functools import wraps
-from datetime import datetime, timedelta
 from lru import LRU
 
 
@@ -13,19 +22,319 @@ class Strategy(enum.Enum):
 
     timed = 2
 
+    swr = 3
+
+
+# every decorated function by name, used by the owner caches command
+registry = {}
+
+
+class CacheStats:
+    __slots__ = ("name", "hits", "misses", "evictions", "expirations", "refreshes", "computed", "compute_time",
+                 "time_saved", "bytes", "stores")
+
+    def __init__(self, name):
+        self.name = name
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.refreshes = 0
+        # how many misses were computed and how long they took, hits are credited with the average
+        self.computed = 0
+        self.compute_time = 0.0
+        self.time_saved = 0.0
+        # estimated size of what's held in memory
+        self.bytes = 0
+        self.stores = ()
+
+    @property
+    def size(self):
+        return sum(len(store) for store in self.stores)
+
+    @property
+    def hit_rate(self):
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+    def record_hit(self):
+        self.hits += 1
+
+        if self.computed:
+            self.time_saved += self.compute_time / self.computed
+
+    def record_compute(self, elapsed):
+        self.computed += 1
+        self.compute_time += elapsed
+
+    def record_eviction(self, *_):
+        self.evictions += 1
+
+    def record_expiration(self, *_):
+        self.expirations += 1
+
+    def reset(self):
+        self.hits = self.misses = self.evictions = self.expirations = self.refreshes = self.computed = 0
+        self.compute_time = self.time_saved = 0.0
+
+
+# raised when a stored value's class was renamed or moved since it was pickled
+UNPICKLING_ERRORS = (pickle.UnpicklingError, AttributeError, ImportError, EOFError, TypeError)
+# a backend being unreachable is treated as a miss rather than failing the call
+POSTGRES_ERRORS = (asyncpg.PostgresError, asyncpg.InterfaceError, OSError, asyncio.TimeoutError)
+
+
+def _dumps(value):
+    try:
+
+        return pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+
+    except (pickle.PicklingError, TypeError, AttributeError, RecursionError):
+        # not everything can be persisted, those values only live in memory
+        return None
+
+
+class PostgresBackend:
+    """Persists values to the unlogged cache_entry table so they survive restarts
+    and can be shared between bot processes.
+
+    The pool is bound by the bot once it has connected, until then every lookup misses.
+    """
+
+    pool = None
+
+    async def get(self, namespace, key):
+        if self.pool is None:
+            raise KeyError(key)
+
+        try:
+            row = await self.pool.fetchrow("""SELECT value, EXTRACT(EPOCH FROM expires_at)::float8 AS expires_at
+                                              FROM cache_entry WHERE namespace = $1 AND key = $2
+                                              AND (expires_at IS NULL OR expires_at > now())""", namespace, key)
+        except POSTGRES_ERRORS:
+            raise KeyError(key)
+
+        if row is None:
+            raise KeyError(key)
+
+        try:
+            return pickle.loads(row["value"]), row["expires_at"]
+        except UNPICKLING_ERRORS:
+            await self.delete(namespace, key)
+            raise KeyError(key)
+
+    async def set(self, namespace, key, value, ttl=None):
+        data = _dumps(value)
+
+        if self.pool is None or data is None:
+            return
+
+        try:
+            await self.pool.execute("""INSERT INTO cache_entry (namespace, key, value, expires_at)
+                                       VALUES ($1, $2, $3, now() + $4::float8 * interval '1 second')
+                                       ON CONFLICT (namespace, key) DO UPDATE
+                                       SET value = $3, expires_at = now() + $4::float8 * interval '1 second'""",
+                                    namespace, key, data, ttl)
+        except POSTGRES_ERRORS:
+            # the value is still cached in memory
+            pass
+
+    async def delete(self, namespace, key):
+        if self.pool is None:
+            return
+
+        try:
+            await self.pool.execute("DELETE FROM cache_entry WHERE namespace = $1 AND key = $2", namespace, key)
+        except POSTGRES_ERRORS:
+            pass
+
+    async def clear(self, namespace):
+        if self.pool is not None:
+            await self.pool.execute("DELETE FROM cache_entry WHERE namespace = $1", namespace)
+
+
+class DiskBackend:
+    """Persists values as pickle files under ``path``, one directory per cached function.
+
+    File io is done in the default executor so the event loop isn't blocked. Expired
+    files are removed when they're read or by :meth:`sweep`, which the bot runs at startup.
+    """
+
+    def __init__(self, path):
+        self.path = path
+
+    def __directory(self, namespace):
+        return os.path.join(self.path, namespace)
+
+    def __file(self, namespace, key):
+        return os.path.join(self.__directory(namespace), hashlib.sha1(key.encode()).hexdigest())
+
+    def __read(self, namespace, key):
+        file = self.__file(namespace, key)
+
+        try:
+            with open(file, "rb") as f:
+                stored_key, expires_at, value = pickle.load(f)
+
+        except (OSError, ValueError, *UNPICKLING_ERRORS):
+            raise KeyError(key)
+
+        if expires_at is not None and time.time() >= expires_at:
+            self.__remove(file)
+            raise KeyError(key)
+
+        # guarding against hash collisions
+        if stored_key != key:
+            raise KeyError(key)
 
-def _wrap_coroutine_in_dict(cache_dict, key, future):
+        try:
+            return pickle.loads(value), expires_at
+        except UNPICKLING_ERRORS:
+            self.__remove(file)
+            raise KeyError(key)
+
+    def __write(self, namespace, key, data, ttl):
+        file = self.__file(namespace, key)
+        expires_at = time.time() + ttl if ttl is not None else None
+        os.makedirs(self.__directory(namespace), exist_ok=True)
+
+        tmp = f"{file}.{os.getpid()}.tmp"
+        with open(tmp, "wb") as f:
+            pickle.dump((key, expires_at, data), f, pickle.HIGHEST_PROTOCOL)
+
+        os.replace(tmp, file)
+
+    @staticmethod
+    def __remove(file):
+        try:
+            os.remove(file)
+        except FileNotFoundError:
+            pass
+
+    def __sweep(self):
+        removed = 0
+        now = time.time()
+
+        for directory, _, files in os.walk(self.path):
+            for name in files:
+                file = os.path.join(directory, name)
+
+                try:
+                    with open(file, "rb") as f:
+                        _, expires_at, _ = pickle.load(f)
+
+                except (OSError, ValueError, *UNPICKLING_ERRORS):
+                    # half written temporary files and anything unreadable
+                    expires_at = now
+
+                if expires_at is not None and now >= expires_at:
+                    self.__remove(file)
+                    removed += 1
+
+        return removed
+
+    def __clear(self, namespace):
+        directory = self.__directory(namespace)
+
+        if not os.path.isdir(directory):
+            return
+
+        for name in os.listdir(directory):
+            self.__remove(os.path.join(directory, name))
+
+    async def get(self, namespace, key):
+        return await asyncio.get_event_loop().run_in_executor(None, self.__read, namespace, key)
+
+    async def set(self, namespace, key, value, ttl=None):
+        data = _dumps(value)
+
+        if data is None:
+            return
+
+        try:
+            await asyncio.get_event_loop().run_in_executor(None, self.__write, namespace, key, data, ttl)
+        except OSError:
+            # the value is still cached in memory
+            pass
+
+    async def delete(self, namespace, key):
+        await asyncio.get_event_loop().run_in_executor(None, self.__remove, self.__file(namespace, key))
+
+    async def clear(self, namespace):
+        await asyncio.get_event_loop().run_in_executor(None, self.__clear, namespace)
+
+    async def sweep(self):
+        """Removes every expired file under ``path``, returning how many were removed."""
+        return await asyncio.get_event_loop().run_in_executor(None, self.__sweep)
+
+
+def _wrap_coroutine_in_task(in_flight, key, coro):
+    # the task is shared by every caller that misses on this key while it's running
 
     async def wrapper():
 
-        val = await future
-        cache_dict[key] = val
+        try:
 
-        return val
+            return await coro
+
+        finally:
+            del in_flight[key]
+
+    task = asyncio.ensure_future(wrapper())
+    in_flight[key] = task
+
+    return task
+
+
+def _wrap_task_in_coroutine(task):
+
+    async def wrapper():
+        # shielded so one cancelled caller doesn't cancel the request for everyone else waiting on it
+        return await asyncio.shield(task)
 
     return wrapper()
 
 
+def total_bytes():
+    """Estimated bytes held by every registered cache."""
+    return sum(func.get_stats().bytes for func in registry.values())
+
+
+def approximate_size(value):
+    """Rough number of bytes ``value`` holds, following containers and instance dicts."""
+    seen = set()
+    stack = [value]
+    size = 0
+
+    while stack:
+        obj = stack.pop()
+
+        if id(obj) in seen:
+            continue
+
+        seen.add(id(obj))
+        size += sys.getsizeof(obj)
+
+        if isinstance(obj, (str, bytes, bytearray, int, float)):
+            continue
+
+        if isinstance(obj, dict):
+            stack.extend(obj.keys())
+            stack.extend(obj.values())
+
+        elif isinstance(obj, (list, tuple, set, frozenset)):
+            stack.extend(obj)
+
+        elif hasattr(obj, "__dict__"):
+            stack.append(obj.__dict__)
+
+    return size
+
+
+def _is_empty(value):
+    return value is None or value is False
+
+
 def _wrap_value_in_coroutine(val):
 
     async def wrapper():
@@ -36,48 +345,336 @@ def _wrap_value_in_coroutine(val):
 
 
 class ExpiringCache(dict):
-    def __init__(self, minutes):
-        self._ttl = timedelta(minutes=minutes)
+    """A dict where every entry expires ``seconds`` after it was set.
+
+    Deadlines are taken from a monotonic clock and kept in a min-heap, so a lookup
+    only checks the key being looked up and expired entries are popped off the top
+    of the heap on writes. If ``maxsize`` is given the entry closest to expiring is
+    evicted once the cache grows past it.
+    """
+
+    def __init__(self, seconds, maxsize=None, callback=None, expire_callback=None):
+        self._ttl = seconds
+        self._maxsize = maxsize
+        # called with the key and value of entries evicted for space/entries that expired
+        self._callback = callback
+        self._expire_callback = expire_callback
         self._ttl_dict = {}
+        self._heap = []
+        self._counter = itertools.count()
         super().__init__()
 
-    def __verify_cache(self):
-        # creating a shallow copy
-        d = (k for k in copy.copy(self) if datetime.utcnow() >= self._ttl_dict.get(k))
+    def __expired(self, key, now):
+        return now >= self._ttl_dict[key]
+
+    def __pop_heap(self):
+        # heap entries go stale when a key is set again or deleted, those are skipped
+        while self._heap:
+            deadline, _, key = heapq.heappop(self._heap)
+            if self._ttl_dict.get(key) == deadline:
+                return key
 
-        for k in d:
-            del self._ttl_dict[k]
-            del self[k]
+        return None
+
+    def __remove(self, key, callback):
+        value = super().__getitem__(key)
+        self.__delitem__(key)
+
+        if callback is not None:
+            callback(key, value)
+
+    def __purge(self, now):
+        while self._heap and self._heap[0][0] <= now:
+            deadline, _, key = heapq.heappop(self._heap)
+            if self._ttl_dict.get(key) == deadline:
+                self.__remove(key, self._expire_callback)
+
+    def __push(self, key, deadline):
+        heapq.heappush(self._heap, (deadline, next(self._counter), key))
+
+    def __compact(self):
+        self._heap = [(deadline, next(self._counter), key) for key, deadline in self._ttl_dict.items()]
+        heapq.heapify(self._heap)
 
     def setitem_ttl_dict(self, key, ttl):
         self._ttl_dict[key] = ttl
+        self.__push(key, ttl)
 
     def __getitem__(self, k):
-        self.__verify_cache()
+        if k in self._ttl_dict and self.__expired(k, time.monotonic()):
+            self.__remove(k, self._expire_callback)
+
         return super().__getitem__(k)
 
-    def __setitem__(self, key, value):
+    def __contains__(self, k):
+        try:
+            self.__getitem__(k)
+        except KeyError:
+            return False
+
+        return True
+
+    def get(self, k, default=None):
+        try:
+            return self.__getitem__(k)
+        except KeyError:
+            return default
+
+    def peek_last_item(self):
+        """The (key, value) pair closest to expiring, mirroring ``LRU.peek_last_item``."""
+        while self._heap:
+            deadline, _, key = self._heap[0]
+            if self._ttl_dict.get(key) == deadline:
+                return key, super().__getitem__(key)
+
+            heapq.heappop(self._heap)
+
+        return None
 
-        if key not in self._ttl_dict:
-            ttl = datetime.utcnow() + self._ttl
-            self.setitem_ttl_dict(key, ttl)
+    def remaining(self, key):
+        """Seconds left until ``key`` expires."""
+        return self._ttl_dict[key] - time.monotonic()
 
+    def __setitem__(self, key, value):
+        self.set(key, value)
+
+    def set(self, key, value, seconds=None):
+        """Sets a value which expires after ``seconds`` rather than the cache wide ttl."""
+        now = time.monotonic()
+        self.__purge(now)
+        self.setitem_ttl_dict(key, now + (self._ttl if seconds is None else seconds))
         super().__setitem__(key, value)
 
+        if self._maxsize is not None:
+            while len(self) > self._maxsize:
+                self.__remove(self.__pop_heap(), self._callback)
+
+        if len(self._heap) > 2 * len(self) + 64:
+            self.__compact()
+
+    def __delitem__(self, key):
+        super().__delitem__(key)
+        del self._ttl_dict[key]
+
+    def clear(self):
+        super().clear()
+        self._ttl_dict.clear()
+        self._heap.clear()
+
+
+def cache(maxsize=256, strategy=Strategy.lru, ttl=None, key=None, ignore=(), backend=None, hard_ttl=None,
+          negative_ttl=None, negative=_is_empty, max_bytes=None, sizeof=approximate_size):
+    """Memoize a function or coroutine function.
+
+    By default the key is built from every argument the function is called with,
+    ``ignore`` takes argument names to leave out of it (e.g. ``ctx``) and ``key``
+    takes a callable which is passed the same arguments and returns what to key on
+    instead. A ``self`` argument is keyed on a per-instance token which only holds
+    a weak reference to the instance.
+
+    ``backend`` takes a :class:`PostgresBackend` or :class:`DiskBackend` which
+    coroutine functions fall back to on a miss in memory, values are stored there
+    with ``ttl`` (or indefinitely without one). ``Strategy.lru`` never expires
+    entries in memory, so it only takes a ``ttl`` along with a backend.
+
+    With ``Strategy.swr`` entries older than ``ttl`` are still returned straight
+    away while they're refreshed in the background, a caller only waits on the
+    function once an entry is older than ``hard_ttl``.
+
+    If ``negative_ttl`` is given values which ``negative`` returns True for (by
+    default None and False, i.e. nothing was found) are kept separately for that
+    many seconds, so lookups for things that don't exist aren't cached as long.
 
-def cache(maxsize=256, strategy=Strategy.lru):
+    ``sizeof`` estimates how many bytes a value takes, if ``max_bytes`` is given
+    entries are evicted until the total is back under it as well as by count.
+
+    ``prime(value, *args, ttl=None, **kwargs)`` stores a value fetched elsewhere
+    under the key ``args`` and ``kwargs`` would make, for ``ttl`` seconds instead
+    of the cache's own if it's given.
+    """
     def memoize(f):
+        name = f"{f.__module__.rsplit('.', 1)[-1]}.{f.__qualname__}"
+        is_coroutine = asyncio.iscoroutinefunction(f)
+
+        if backend is not None and not is_coroutine:
+            raise TypeError(f"{f.__qualname__} needs to be a coroutine function to use a backend.")
+
+        if strategy is Strategy.swr and not is_coroutine:
+            raise TypeError(f"{f.__qualname__} needs to be a coroutine function to be refreshed in the background.")
+
+        __stats = CacheStats(name)
+        __weights = {}
+        # key -> when a background refresh which failed can be tried again
+        __retry_at = {}
+
+        def drop_weight(key):
+            __stats.bytes -= __weights.pop(key, 0)
+            __retry_at.pop(key, None)
+
+        def evicted(key, _):
+            __stats.record_eviction()
+            drop_weight(key)
+
+        def expired(key, _):
+            __stats.record_expiration()
+            drop_weight(key)
+
         if strategy is Strategy.lru:
-            __cache = LRU(maxsize)
-            __stats = __cache.items
+            if ttl is not None and backend is None:
+                # lru entries never expire in memory, a ttl only applies to what's kept in a backend
+                raise ValueError(f"{f.__qualname__} was given a ttl without a backend, use Strategy.timed for "
+                                 f"entries that expire in memory.")
+
+            __cache = LRU(maxsize, callback=evicted)
 
         elif strategy is Strategy.timed:
-            __cache = ExpiringCache(maxsize)
-            __stats = __cache.items
+            if ttl is None:
+                raise ValueError("timed caches need a ttl in seconds.")
+
+            __cache = ExpiringCache(ttl, maxsize, callback=evicted, expire_callback=expired)
+
+        elif strategy is Strategy.swr:
+            if ttl is None or hard_ttl is None or hard_ttl < ttl:
+                raise ValueError("stale while revalidate caches need a ttl and a hard_ttl at least as long.")
+
+            __cache = ExpiringCache(hard_ttl, maxsize, callback=evicted, expire_callback=expired)
+
+        # an empty dict stands in when negative results aren't cached separately
+        __negatives = {}
+
+        if negative_ttl is not None:
+            __negatives = ExpiringCache(negative_ttl, maxsize, callback=__stats.record_eviction,
+                                        expire_callback=__stats.record_expiration)
+
+        __stats.stores = (__cache, __negatives)
+        # how long values are kept in a backend
+        __ttl = hard_ttl if strategy is Strategy.swr else ttl
+
+        __in_flight = {}
+        __signature = inspect.signature(f)
+        __is_method = next(iter(__signature.parameters), None) == "self"
+        __owners = weakref.WeakKeyDictionary()
+        __tokens = itertools.count()
+
+        for argument in ignore:
+            if argument not in __signature.parameters:
+                raise ValueError(f"{f.__qualname__} has no argument named {argument} to ignore.")
+
+        def owner_token(owner):
+            try:
+
+                return __owners[owner]
+
+            except KeyError:
+
+                token = __owners[owner] = next(__tokens)
+                return token
+
+            except TypeError:
+                # not hashable or can't be weakly referenced
+                return id(owner)
 
         def make_key(*args, **kwargs):
-            key = f"{f.__module__}#{f.__name__}#{repr((args, kwargs))}"
-            return key
+            if key is not None:
+                return f"{f.__module__}#{f.__name__}#{repr(key(*args, **kwargs))}"
+
+            bound = __signature.bind(*args, **kwargs)
+            bound.apply_defaults()
+
+            if __is_method:
+                bound.arguments["self"] = owner_token(bound.arguments["self"])
+
+            arguments = tuple((k, v) for k, v in bound.arguments.items() if k not in ignore)
+
+            return f"{f.__module__}#{f.__name__}#{repr(arguments)}"
+
+        def is_negative(val):
+            return negative_ttl is not None and negative(val)
+
+        def evict_by_weight():
+            while __stats.bytes > max_bytes and len(__cache):
+                key, val = __cache.peek_last_item()
+                del __cache[key]
+                evicted(key, val)
+
+        def discard(target, key):
+            try:
+                del target[key]
+
+            except KeyError:
+                pass
+
+        def store(key, val, seconds=None):
+            # a key is only ever held in one of the two, otherwise a stale positive keeps being served
+            # over a newer negative result
+            if is_negative(val):
+                target = __negatives
+                discard(__cache, key)
+                drop_weight(key)
+            else:
+                target = __cache
+                discard(__negatives, key)
+                drop_weight(key)
+                __weights[key] = sizeof(val)
+                __stats.bytes += __weights[key]
+
+            if seconds is not None and isinstance(target, ExpiringCache):
+                target.set(key, val, seconds)
+            else:
+                target[key] = val
+
+            if max_bytes is not None:
+                evict_by_weight()
+
+        async def load(key, args, kwargs, refresh=False):
+            if backend is not None and not refresh:
+                try:
+
+                    val, expires_at = await backend.get(name, key)
+
+                except KeyError:
+
+                    pass
+
+                else:
+
+                    store(key, val, None if expires_at is None else expires_at - time.time())
+                    return val
+
+            start = time.perf_counter()
+            val = await f(*args, **kwargs)
+            __stats.record_compute(time.perf_counter() - start)
+            store(key, val)
+
+            if backend is not None:
+                await backend.set(name, key, val, negative_ttl if is_negative(val) else __ttl)
+
+            return val
+
+        def refresh_failed(key, task):
+            # background refreshes have nobody awaiting them, the stale value keeps being served on failure
+            # and the next refresh waits another ttl rather than starting on the very next hit
+            if not task.cancelled() and task.exception() is not None and key in __cache:
+                __retry_at[key] = time.monotonic() + ttl
+
+        def miss(key, args, kwargs):
+            if key in __in_flight:
+                # coalesced onto a call that's already running
+                __stats.record_hit()
+                return _wrap_task_in_coroutine(__in_flight[key])
+
+            __stats.misses += 1
+
+            if is_coroutine:
+                task = _wrap_coroutine_in_task(__in_flight, key, load(key, args, kwargs))
+                return _wrap_task_in_coroutine(task)
+
+            start = time.perf_counter()
+            val = f(*args, **kwargs)
+            __stats.record_compute(time.perf_counter() - start)
+            store(key, val)
+
+            return val
 
         @wraps(f)
         def wrapper(*args, **kwargs):
@@ -90,39 +687,62 @@ def cache(maxsize=256, strategy=Strategy.lru):
 
             except KeyError:
 
-                val = f(*args, **kwargs)
-
-                if asyncio.iscoroutine(val):
+                try:
+                    val = __negatives[key]
 
-                    return _wrap_coroutine_in_dict(__cache, key, val)
+                except KeyError:
+                    return miss(key, args, kwargs)
 
-                __cache[key] = val
+            else:
 
-                return val
+                if (strategy is Strategy.swr and key not in __in_flight
+                        and __cache.remaining(key) < hard_ttl - ttl and time.monotonic() >= __retry_at.get(key, 0)):
+                    __stats.refreshes += 1
+                    task = _wrap_coroutine_in_task(__in_flight, key, load(key, args, kwargs, refresh=True))
+                    task.add_done_callback(partial(refresh_failed, key))
 
-            else:
+            __stats.record_hit()
 
-                if asyncio.iscoroutinefunction(f):
+            if is_coroutine:
 
-                    return _wrap_value_in_coroutine(val)
+                return _wrap_value_in_coroutine(val)
 
-                return val
+            return val
 
         def __invalidate(*args, **kwargs):
             key = make_key(*args, **kwargs)
 
-            try:
-                del __cache[key]
+            for target in (__cache, __negatives):
+                discard(target, key)
 
-            except KeyError:
-                pass
+            drop_weight(key)
+
+            if backend is not None:
+                asyncio.ensure_future(backend.delete(name, key))
+
+        def __prime(val, *args, ttl=None, **kwargs):
+            key = make_key(*args, **kwargs)
+            store(key, val, ttl)
+
+            if backend is not None:
+                asyncio.ensure_future(backend.set(name, key, val, ttl or __ttl))
 
         def __clear():
             __cache.clear()
+            __negatives.clear()
+            __weights.clear()
+            __retry_at.clear()
+            __stats.bytes = 0
+            __stats.reset()
+
+            if backend is not None:
+                asyncio.ensure_future(backend.clear(name))
 
-        wrapper.get_stats = __stats
+        wrapper.get_stats = lambda: __stats
         wrapper.invalidate = __invalidate
+        wrapper.prime = __prime
         wrapper.clear = __clear
+        registry[name] = wrapper
         return wrapper
 
     return memoize
@@ -0,0 +1,172 @@
+import heapq
+
+from bisect import bisect_left
+from collections import namedtuple
+
+Zone = namedtuple("Zone", "id name frozen expansion_name")
+Encounter = namedtuple("Encounter", "id name zone_id alias_s alias_n expansion_name")
+Difficulty = namedtuple("Difficulty", "name diff_id")
+World = namedtuple("World", "name region dc_name")
+
+
+def _prefix_match(index, prefix):
+    # index is a sorted list of (lowered name, id) pairs
+    prefix = prefix.lower()
+    i = bisect_left(index, (prefix,))
+
+    if i < len(index) and index[i][0].startswith(prefix):
+        return index[i][1]
+
+    return None
+
+
+def trigrams(text):
+    # padded so short names and the start of words still get a few trigrams
+    text = f"  {text.lower()} "
+    return {text[i:i + 3] for i in range(len(text) - 2)}
+
+
+class TrigramIndex:
+    """Names indexed by their trigrams for "did you mean" lookups.
+
+    Only names sharing at least one trigram with the query are scored, by the
+    jaccard similarity of their trigram sets.
+    """
+
+    def __init__(self, names):
+        self.names = []
+        # trigram -> indexes into names
+        self.postings = {}
+
+        for name in dict.fromkeys(names):
+            grams = trigrams(name)
+            i = len(self.names)
+            self.names.append((name, len(grams)))
+
+            for gram in grams:
+                self.postings.setdefault(gram, []).append(i)
+
+    def search(self, query, limit=3, cutoff=0.3):
+        grams = trigrams(query)
+        shared = {}
+
+        for gram in grams:
+            for i in self.postings.get(gram, ()):
+                shared[i] = shared.get(i, 0) + 1
+
+        scored = []
+
+        for i, count in shared.items():
+            name, size = self.names[i]
+            score = count / (len(grams) + size - count)
+
+            if score >= cutoff:
+                scored.append((score, name))
+
+        return [name for _, name in heapq.nlargest(limit, scored)]
+
+
+class Catalog:
+    """The zone, encounter, difficulties, bracket and world tables held in memory.
+
+    Loaded once at startup and again whenever they're updated, since they only
+    change when the owner adds zones or worlds.
+    """
+
+    def __init__(self):
+        self.zones = {}
+        self.encounters = {}
+        # zone id -> difficulties and encounter ids in that zone
+        self.difficulties = {}
+        self.zone_encounters = {}
+        # expansion name -> highest patch of the bracket
+        self.brackets = {}
+        # lowered world name -> world
+        self.worlds = {}
+        self.difficulty_names = ()
+        self.dungeons = ()
+        self.encounter_name_length = 0
+        self.__zone_index = []
+        self.__encounter_index = []
+        self.__zone_matches = TrigramIndex(())
+        self.__encounter_matches = TrigramIndex(())
+
+    async def load(self, con):
+        zones = {r["id"]: Zone(r["id"], r["name"], r["frozen"], r["expansion_name"])
+                 for r in await con.fetch("SELECT id, name, frozen, expansion_name FROM zone ORDER BY id")}
+
+        encounters = {r["id"]: Encounter(r["id"], r["name"], r["zone_id"], r["alias_s"], r["alias_n"],
+                                         r["expansion_name"])
+                      for r in await con.fetch("""SELECT id, name, zone_id, alias_s, alias_n, expansion_name
+                                                  FROM encounter ORDER BY id""")}
+
+        difficulties = {}
+        # add_zones inserts difficulties every time it's ran so duplicates are dropped here
+        for r in await con.fetch("SELECT DISTINCT zone_id, name, diff_id FROM difficulties ORDER BY zone_id, diff_id"):
+            difficulties.setdefault(r["zone_id"], []).append(Difficulty(r["name"], r["diff_id"]))
+
+        zone_encounters = {}
+        for encounter in encounters.values():
+            zone_encounters.setdefault(encounter.zone_id, []).append(encounter.id)
+
+        brackets = {r["expansion_name"]: r["max"] for r in await con.fetch("SELECT expansion_name, max FROM bracket")}
+
+        worlds = {r["name"].lower(): World(r["name"], r["region"], r["dc_name"])
+                  for r in await con.fetch("SELECT name, region, dc_name FROM world")}
+
+        encounter_index = []
+        for encounter in encounters.values():
+            for name in (encounter.name, encounter.alias_s, encounter.alias_n):
+                if name:
+                    encounter_index.append((name.lower(), encounter.id))
+
+        self.zones = zones
+        self.encounters = encounters
+        self.difficulties = {k: tuple(v) for k, v in difficulties.items()}
+        self.zone_encounters = {k: tuple(v) for k, v in zone_encounters.items()}
+        self.brackets = brackets
+        self.worlds = worlds
+        self.difficulty_names = tuple(dict.fromkeys(d.name for v in difficulties.values() for d in v))
+        self.dungeons = tuple(z.id for z in zones.values() if z.name.startswith("Dungeon"))
+        self.encounter_name_length = max((len(e.name) for e in encounters.values()), default=0)
+        self.__zone_index = sorted((z.name.lower(), z.id) for z in zones.values())
+        self.__encounter_index = sorted(encounter_index)
+        self.__zone_matches = TrigramIndex(z.name for z in zones.values())
+        # aliases are suggested as they are since they're what people type
+        self.__encounter_matches = TrigramIndex(name for e in encounters.values()
+                                                for name in (e.name, e.alias_s, e.alias_n) if name)
+
+    def find_zone(self, prefix):
+        """The id of the first zone starting with ``prefix`` ignoring case, or None."""
+        return _prefix_match(self.__zone_index, prefix)
+
+    def find_encounter(self, prefix):
+        """The id of the first encounter whose name or alias starts with ``prefix`` ignoring case, or None."""
+        return _prefix_match(self.__encounter_index, prefix)
+
+    def similar_zones(self, name, limit=3):
+        """Zone names close to ``name`` for suggesting when nothing starts with it."""
+        return self.__zone_matches.search(name, limit)
+
+    def similar_encounters(self, name, limit=3):
+        """Encounter names and aliases close to ``name`` for suggesting when nothing starts with it."""
+        return self.__encounter_matches.search(name, limit)
+
+    def zone_name(self, zone_id):
+        zone = self.zones.get(zone_id)
+        return zone.name if zone else None
+
+    def encounter_name(self, encounter_id):
+        encounter = self.encounters.get(encounter_id)
+        return encounter.name if encounter else None
+
+    def world(self, name):
+        return self.worlds.get(name.lower())
+
+    def region(self, world):
+        world = self.world(world)
+        return world.region if world else None
+
+    def current_dungeon(self):
+        # the dungeon zone from the latest expansion
+        return max(self.dungeons, key=lambda z: self.brackets.get(self.zones[z].expansion_name) or 0, default=None)
@@ -31,9 +31,7 @@ class CharacterAndWorldConverter(commands.Converter):
         if isinstance(argument, str):
             args = argument.split(" ")
 
-            check = await ctx.db.fetchval("SELECT name from world where LOWER(name) like $1", args[0].lower())
-
-            if not check:
+            if not ctx.bot.catalog.world(args[0]):
                 raise commands.BadArgument(f"Invalid ffxiv world `{args[0]}` was passed.")
 
             if len(args) < 3:
@@ -47,6 +45,16 @@ class CharacterAndWorldConverter(commands.Converter):
         return await DiscordToCharacterConverter().convert(ctx, argument)
 
 
+class RefreshConverter(commands.Converter):
+    # optional flag for skipping cached results
+    async def convert(self, ctx, argument):
+
+        if argument.lower() in ("refresh", "--refresh"):
+            return True
+
+        raise commands.BadArgument(f"`{argument}` is not refresh.")
+
+
 def check_argument_against_alias_dict(argument, _dict, error_msg):
 
     if not argument:
@@ -0,0 +1,35 @@
+import asyncio
+import functools
+
+from concurrent.futures import ThreadPoolExecutor
+
+from bs4 import BeautifulSoup
+
+try:
+    import lxml  # noqa: F401
+except ImportError:
+    PARSER = "html.parser"
+else:
+    # considerably faster than the builtin parser when it's installed
+    PARSER = "lxml"
+
+# parsing a full page takes long enough to be noticeable when it's done on the event loop, the pool still shares
+# the GIL with it so lxml is in the requirements to keep each parse short
+_executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix="parser")
+
+
+def make_soup(markup, parse_only=None):
+    return BeautifulSoup(markup, PARSER, parse_only=parse_only)
+
+
+def _parse(extract, markup, parse_only, args):
+    return extract(make_soup(markup, parse_only), *args)
+
+
+async def parse(markup, extract, *args, parse_only=None):
+    """Parses ``markup`` in the parser pool and returns ``extract(soup, *args)``.
+
+    The soup never leaves the pool so ``extract`` should return plain data.
+    """
+    loop = asyncio.get_event_loop()
+    return await loop.run_in_executor(_executor, functools.partial(_parse, extract, markup, parse_only, args))
@@ -0,0 +1,282 @@
+import os
+import json
+import time
+import base64
+import random
+import asyncio
+import hashlib
+
+from urllib.parse import urlsplit, urlunsplit, urlencode, parse_qsl
+
+import aiohttp
+
+from multidict import CIMultiDict, CIMultiDictProxy
+
+from config.utils.requests import RequestFailed
+
+
+class FixtureNotFound(RequestFailed):
+    pass
+
+
+# validators are dropped while recording so full bodies are saved instead of 304s
+CONDITIONAL_HEADERS = ("If-None-Match", "If-Modified-Since")
+# query params holding api keys, pyxivapi adds private_key to every url
+CREDENTIAL_PARAMS = ("private_key",)
+# response headers which aren't saved
+CREDENTIAL_HEADERS = ("set-cookie",)
+
+
+class Cassette:
+    """Recorded responses saved as one json file per request under ``path/host``.
+
+    Requests are matched on their method, url, query params and body. Request headers
+    (and so any Authorization header) are never saved, credential query params are
+    stripped from the url and key and requests passing ``auth`` aren't saved at all,
+    so keys and tokens never end up in a fixture.
+    """
+
+    def __init__(self, path):
+        self.path = path
+
+    @staticmethod
+    def strip_credentials(url, params=None):
+        parts = urlsplit(str(url))
+        query = [(k, v) for k, v in parse_qsl(parts.query, keep_blank_values=True) if k not in CREDENTIAL_PARAMS]
+        url = urlunsplit(parts._replace(query=urlencode(query)))
+
+        if params:
+            params = {k: v for k, v in dict(params).items() if k not in CREDENTIAL_PARAMS}
+
+        return url, params
+
+    @classmethod
+    def make_key(cls, method, url, params=None, json_body=None, data=None):
+        url, params = cls.strip_credentials(url, params)
+        key = f"{method.upper()} {url}"
+
+        if params:
+            key += f"?{urlencode(sorted(dict(params).items()))}"
+
+        if json_body is not None:
+            key += f" {json.dumps(json_body, sort_keys=True)}"
+
+        elif data is not None:
+            key += f" {sorted(data.items()) if isinstance(data, dict) else data!r}"
+
+        return key
+
+    def file(self, url, key):
+        host = urlsplit(str(url)).hostname or "unknown"
+        return os.path.join(self.path, host, f"{hashlib.sha1(key.encode()).hexdigest()}.json")
+
+    def _read(self, file):
+        with open(file) as f:
+            return json.load(f)
+
+    def _write(self, file, fixture):
+        os.makedirs(os.path.dirname(file), exist_ok=True)
+        tmp = f"{file}.{os.getpid()}.tmp"
+
+        with open(tmp, "w") as f:
+            json.dump(fixture, f, indent=2)
+
+        os.replace(tmp, file)
+
+    async def load(self, url, key):
+        loop = asyncio.get_event_loop()
+
+        try:
+            return await loop.run_in_executor(None, self._read, self.file(url, key))
+        except FileNotFoundError:
+            raise FixtureNotFound(f"there's no recorded response for `{key}`.")
+
+    async def save(self, url, key, fixture):
+        loop = asyncio.get_event_loop()
+        await loop.run_in_executor(None, self._write, self.file(url, key), fixture)
+
+
+class _Content:
+
+    __slots__ = ("body",)
+
+    def __init__(self, body):
+        self.body = body
+
+    async def read(self, n=-1):
+        return self.body
+
+    async def iter_chunked(self, n):
+        for i in range(0, len(self.body), n):
+            yield self.body[i:i + n]
+
+
+class ReplayResponse:
+    """Stands in for an ``aiohttp.ClientResponse`` with the body already read."""
+
+    def __init__(self, url, status, reason, headers, body):
+        self.url = url
+        self.status = status
+        self.reason = reason
+        self.headers = CIMultiDictProxy(CIMultiDict(headers))
+        self.body = body
+        self.content = _Content(body)
+
+    @classmethod
+    def from_fixture(cls, fixture):
+        return cls(fixture["url"], fixture["status"], fixture["reason"], fixture["headers"],
+                   base64.b64decode(fixture["body"]))
+
+    @property
+    def content_type(self):
+        return self.headers.get("content-type", "application/octet-stream").split(";")[0]
+
+    @property
+    def content_length(self):
+        return len(self.body)
+
+    async def read(self):
+        return self.body
+
+    async def text(self, encoding="utf-8"):
+        return self.body.decode(encoding)
+
+    async def json(self, content_type=None, loads=json.loads):
+        return loads(self.body)
+
+    def raise_for_status(self):
+        if self.status >= 400:
+            raise aiohttp.ClientResponseError(None, (), status=self.status, message=self.reason)
+
+    def release(self):
+        pass
+
+    def close(self):
+        pass
+
+
+class _ResponseContext:
+
+    __slots__ = ("coro", "response")
+
+    def __init__(self, coro):
+        self.coro = coro
+        self.response = None
+
+    def __await__(self):
+        return self.coro.__await__()
+
+    async def __aenter__(self):
+        self.response = await self.coro
+        return self.response
+
+    async def __aexit__(self, exc_type, exc, tb):
+        self.response.release()
+
+
+class _Session:
+    # get and post are the only calls Request, pyxivapi and FFlogsAPI make through a session,
+    # subclasses define _request
+
+    def __init__(self, cassette):
+        self.cassette = cassette
+
+    def get(self, url, **kwargs):
+        return self.request("GET", url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self.request("POST", url, **kwargs)
+
+    def request(self, method, url, **kwargs):
+        return _ResponseContext(self._request(method, url, **kwargs))
+
+
+class RecordingSession(_Session):
+    """Sends requests through ``session`` as normal while saving every response to ``cassette``."""
+
+    offline = False
+
+    def __init__(self, session, cassette):
+        super().__init__(cassette)
+        self.session = session
+
+    @property
+    def closed(self):
+        return self.session.closed
+
+    async def close(self):
+        await self.session.close()
+
+    async def _request(self, method, url, **kwargs):
+        headers = {k: v for k, v in (kwargs.pop("headers", None) or {}).items() if k not in CONDITIONAL_HEADERS}
+        key = self.cassette.make_key(method, url, kwargs.get("params"), kwargs.get("json"), kwargs.get("data"))
+        start = time.monotonic()
+
+        async with self.session.request(method, url, headers=headers, **kwargs) as response:
+            body = await response.read()
+            fixture = {
+                "url": self.cassette.strip_credentials(url)[0],
+                "key": key,
+                "status": response.status,
+                "reason": response.reason,
+                "headers": [(k, v) for k, v in response.headers.items() if k.lower() not in CREDENTIAL_HEADERS],
+                "elapsed": time.monotonic() - start,
+                "body": base64.b64encode(body).decode()
+            }
+
+        if "auth" not in kwargs:
+            await self.cassette.save(url, key, fixture)
+
+        return ReplayResponse.from_fixture(fixture)
+
+
+class ReplaySession(_Session):
+    """Serves responses saved by a ``RecordingSession`` without touching the network.
+
+    ``latency`` is how many seconds each response is delayed by with up to ``jitter``
+    seconds added on top, if it's None the time the recorded request took is used.
+    """
+
+    offline = True
+
+    def __init__(self, cassette, latency=None, jitter=0.0):
+        super().__init__(cassette)
+        self.latency = latency
+        self.jitter = jitter
+        self.closed = False
+
+    async def close(self):
+        self.closed = True
+
+    async def _request(self, method, url, **kwargs):
+        key = self.cassette.make_key(method, url, kwargs.get("params"), kwargs.get("json"), kwargs.get("data"))
+        fixture = await self.cassette.load(url, key)
+        latency = fixture["elapsed"] if self.latency is None else self.latency
+
+        await asyncio.sleep(latency + random.uniform(0, self.jitter))
+
+        response = ReplayResponse.from_fixture(fixture)
+        etag = response.headers.get("ETag")
+
+        if etag and etag == (kwargs.get("headers") or {}).get("If-None-Match"):
+            return ReplayResponse(response.url, 304, "Not Modified", response.headers, b"")
+
+        return response
+
+
+def wrap_session(session, mode, path, latency=None, jitter=0.0):
+    """Returns the session to use for ``mode``, one of None, "record" or "replay"."""
+    if mode is None:
+        return session
+
+    cassette = Cassette(path)
+
+    if mode == "record":
+        return RecordingSession(session, cassette)
+
+    if mode == "replay":
+        # nothing goes over the network, the real session isn't needed
+        asyncio.ensure_future(session.close())
+        return ReplaySession(cassette, latency, jitter)
+
+    raise ValueError(f"unknown http mode {mode!r}, expected None, 'record' or 'replay'")
@@ -1,12 +1,45 @@
+import os
+import json
+import time
+import hashlib
+import random
+import asyncio
 import functools
+
+from urllib.parse import urlsplit, urlencode
+
 import aiohttp
-import asyncio
+
+from lru import LRU
+
+from config.utils import cache
+from config.utils.cache import DiskBackend, CacheStats
 
 
 class RequestFailed(Exception):
     pass
 
 
+class ServerError(RequestFailed):
+    pass
+
+
+class CircuitOpen(RequestFailed):
+    pass
+
+
+class DownloadFailed(RequestFailed):
+    pass
+
+
+class Unauthorized(RequestFailed):
+    pass
+
+
+# errors which mean the host is having problems rather than the request being bad
+HOST_ERRORS = (asyncio.TimeoutError, aiohttp.ClientConnectionError, ServerError)
+
+
 def error_handle(f):
 
     @functools.wraps(f)
@@ -23,27 +56,382 @@ def error_handle(f):
     return exception
 
 
+def retry(f):
+    # only for idempotent requests, retries host errors with jittered exponential backoff
+
+    @functools.wraps(f)
+    async def wrapper(self, *args, **kwargs):
+
+        for attempt in range(self.retries + 1):
+
+            try:
+
+                return await f(self, *args, **kwargs)
+
+            except HOST_ERRORS:
+
+                if attempt == self.retries:
+                    raise
+
+                await asyncio.sleep(random.uniform(0, self.backoff * 2 ** attempt))
+
+    return wrapper
+
+
+class CircuitBreaker:
+    """Stops sending requests to a host after ``threshold`` failures in a row.
+
+    Once ``reset_timeout`` seconds have passed a single request is let through as a
+    probe, if it succeeds the host is considered back up otherwise it waits again.
+    Only the probe's own result moves the breaker out of open or half open, requests
+    which started before it opened and finish afterwards are ignored.
+    """
+
+    def __init__(self, threshold=5, reset_timeout=30):
+        self.threshold = threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self.probing = False
+
+    @property
+    def state(self):
+        if self.opened_at is None:
+            return "closed"
+
+        if self.probing or time.monotonic() - self.opened_at >= self.reset_timeout:
+            return "half open"
+
+        return "open"
+
+    def before_request(self, host):
+        """Returns True if this request is the probe."""
+        if self.opened_at is None:
+            return False
+
+        if self.probing or time.monotonic() - self.opened_at < self.reset_timeout:
+            raise CircuitOpen(f"`{host}` seems to be down at the moment, try again in a minute.")
+
+        self.probing = True
+        return True
+
+    def record_success(self, probe=False):
+        if self.opened_at is not None and not probe:
+            return
+
+        self.failures = 0
+        self.opened_at = None
+        self.probing = False
+
+    def record_failure(self, probe=False):
+        if probe:
+            self.opened_at = time.monotonic()
+            self.probing = False
+            return
+
+        if self.opened_at is not None:
+            return
+
+        self.failures += 1
+
+        if self.failures >= self.threshold:
+            self.opened_at = time.monotonic()
+
+    def record_cancelled(self, probe=False):
+        if probe:
+            self.probing = False
+
+
+class TokenBucket:
+    """Allows ``rate`` requests a second on average with bursts of up to ``burst``.
+
+    Callers queue on a lock, so requests are let through in the order they arrived.
+    """
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.capacity = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self.lock = asyncio.Lock()
+
+    def __refill(self):
+        now = time.monotonic()
+        # updated is pushed into the future when upstream tells us to back off
+        elapsed = max(0.0, now - self.updated)
+        self.tokens = min(self.capacity, self.tokens + elapsed * self.rate)
+        self.updated = max(self.updated, now)
+
+    async def acquire(self):
+        async with self.lock:
+            self.__refill()
+
+            while self.tokens < 1:
+                await asyncio.sleep(max(self.updated - time.monotonic(), 0) + (1 - self.tokens) / self.rate)
+                self.__refill()
+
+            self.tokens -= 1
+
+    def back_off(self, seconds):
+        self.tokens = 0
+        self.updated = max(self.updated, time.monotonic() + seconds)
+
+
+class _HostSlot:
+
+    __slots__ = ("limiter", "start", "probe")
+
+    def __init__(self, limiter):
+        self.limiter = limiter
+        self.start = None
+        self.probe = False
+
+    async def __aenter__(self):
+        limiter = self.limiter
+        self.probe = limiter.breaker.before_request(limiter.host)
+        self.start = time.monotonic()
+        limiter.waiting += 1
+
+        try:
+            await limiter.semaphore.acquire()
+
+            try:
+                await limiter.bucket.acquire()
+            except BaseException:
+                limiter.semaphore.release()
+                raise
+
+        except BaseException:
+            # __aexit__ never runs for a slot that wasn't entered, so a probe cancelled while queued is let go here
+            limiter.breaker.record_cancelled(self.probe)
+            raise
+
+        finally:
+            limiter.waiting -= 1
+
+        waited = time.monotonic() - self.start
+        limiter.requests += 1
+        limiter.wait_time += waited
+        limiter.max_wait = max(limiter.max_wait, waited)
+
+    async def __aexit__(self, exc_type, exc, tb):
+        self.limiter.semaphore.release()
+        breaker = self.limiter.breaker
+
+        if exc_type is None:
+            breaker.record_success(self.probe)
+
+        elif issubclass(exc_type, HOST_ERRORS):
+            breaker.record_failure(self.probe)
+
+        elif issubclass(exc_type, Exception):
+            # the host answered, the request itself was bad
+            breaker.record_success(self.probe)
+
+        else:
+            breaker.record_cancelled(self.probe)
+
+
+class HostLimiter:
+    """Per host concurrency limit and token bucket, along with how long requests queued for."""
+
+    def __init__(self, host, rate, burst, concurrency):
+        self.host = host
+        self.bucket = TokenBucket(rate, burst)
+        self.semaphore = asyncio.Semaphore(concurrency)
+        self.breaker = CircuitBreaker()
+        # requests currently queued
+        self.waiting = 0
+        self.requests = 0
+        self.wait_time = 0.0
+        self.max_wait = 0.0
+        # 429 responses
+        self.throttled = 0
+
+    @property
+    def average_wait(self):
+        return self.wait_time / self.requests if self.requests else 0.0
+
+    def slot(self):
+        return _HostSlot(self)
+
+    def throttle(self, retry_after):
+        self.throttled += 1
+        self.bucket.back_off(retry_after)
+
+
+class HttpCache:
+    """Response bodies along with their ETag/Last-Modified validators so fetches can be
+    revalidated with a conditional request, kept in memory and optionally on disk under ``path``.
+
+    Memory is bounded by ``maxsize`` entries and ``max_bytes`` of estimated size, it's
+    listed with the decorated caches so it's counted by the caches command and ``total_bytes``.
+    """
+
+    def __init__(self, maxsize=256, path=None, ttl=604800, max_bytes=8 * 1024 * 1024):
+        self.stats = CacheStats("requests.HttpCache")
+        self.memory = LRU(maxsize, callback=self.__evicted)
+        self.stats.stores = (self.memory,)
+        self.max_bytes = max_bytes
+        self.weights = {}
+        self.disk = DiskBackend(path) if path else None
+        # how long bodies are kept on disk
+        self.ttl = ttl
+        # responses answered with a 304
+        self.revalidated = 0
+        cache.registry[self.stats.name] = self
+
+    def __drop_weight(self, key):
+        self.stats.bytes -= self.weights.pop(key, 0)
+
+    def __evicted(self, key, _):
+        self.stats.record_eviction()
+        self.__drop_weight(key)
+
+    def __store(self, key, entry):
+        self.__drop_weight(key)
+        self.weights[key] = cache.approximate_size(entry)
+        self.stats.bytes += self.weights[key]
+        self.memory[key] = entry
+
+        while self.stats.bytes > self.max_bytes and len(self.memory):
+            key, entry = self.memory.peek_last_item()
+            del self.memory[key]
+            self.__evicted(key, entry)
+
+    def get_stats(self):
+        return self.stats
+
+    def clear(self):
+        self.memory.clear()
+        self.weights.clear()
+        self.stats.bytes = 0
+        self.stats.reset()
+
+        if self.disk is not None:
+            asyncio.ensure_future(self.disk.clear("http"))
+
+    @staticmethod
+    def make_key(url, params):
+        if params:
+            return f"{url}?{urlencode(sorted(params.items()))}"
+
+        return str(url)
+
+    async def get(self, key):
+        try:
+
+            entry = self.memory[key]
+
+        except KeyError:
+
+            self.stats.misses += 1
+
+            if self.disk is None:
+                return None
+
+            try:
+                entry, _ = await self.disk.get("http", key)
+            except KeyError:
+                return None
+
+            self.__store(key, entry)
+            return entry
+
+        self.stats.record_hit()
+        return entry
+
+    async def set(self, key, entry):
+        self.__store(key, entry)
+
+        if self.disk is not None:
+            await self.disk.set("http", key, entry, self.ttl)
+
+
 class Request:
-    def __init__(self, bot, session):
-        __slots__ = ("loop", "session")
+    # used for hosts which aren't in the limits passed in and have no default entry
+    DEFAULT_LIMIT = {"rate": 5, "burst": 10, "concurrency": 4}
+
+    def __init__(self, bot, session, limits=None, http_cache=None, retries=2, backoff=0.5):
+        __slots__ = ("loop", "session", "limits", "hosts", "http_cache", "retries", "backoff")
         self.loop = bot.loop
+        self.retries = retries
+        # seconds, doubled on each retry
+        self.backoff = backoff
         self.session = session
+        self.limits = limits or {}
+        self.hosts = {}
+        self.http_cache = http_cache or HttpCache()
+
+    def limiter(self, url):
+        host = urlsplit(str(url)).hostname
+
+        try:
+
+            return self.hosts[host]
+
+        except KeyError:
+
+            limit = self.limits.get(host, self.limits.get("default", self.DEFAULT_LIMIT))
+            limiter = self.hosts[host] = HostLimiter(host, **limit)
+            return limiter
+
+    def check_throttled(self, limiter, response):
+        if response.status != 429:
+            return
+
+        try:
+            retry_after = float(response.headers.get("Retry-After", 1))
+        except ValueError:
+            # can also be a http date, a second is close enough
+            retry_after = 1
+
+        limiter.throttle(retry_after)
+        raise RequestFailed(f"being rate limited by `{limiter.host}`, try again in a few seconds.")
 
     @staticmethod
-    async def return_content(response, headers):
+    def check_server_error(limiter, response):
+        if response.status >= 500:
+            raise ServerError(f"`{limiter.host}` seems to be having problems at the moment `{response.reason}`.")
+
+    @staticmethod
+    def is_json(headers):
+        return headers in ("application/json", "application/javascript", "application/javascript",
+                           "application/json; charset=utf-8") or "json" in headers
+
+    @classmethod
+    def decode_content(cls, body, headers):
+        if headers and cls.is_json(headers):
+            return json.loads(body)
+
+        return body
+
+    @classmethod
+    async def return_content(cls, response, headers):
+        if response.status == 401:
+            raise Unauthorized(f"the credentials for this request were rejected `{response.reason}`.")
+
         if not response.status == 200:
             raise RequestFailed(f"seems like an error occurred for this request this api might be experiencing "
                                 f"problems `{response.reason}`.")
 
-        if headers in ("application/json", "application/javascript", "application/javascript",
-                       "application/json; charset=utf-8") or "json" in headers:
+        if cls.is_json(headers):
             return await response.json()
 
         return await response.read()
 
     @error_handle
-    async def fetch(self, url, **kwargs):
-        async with self.session.get(url, **kwargs) as response:
+    @retry
+    async def fetch(self, url, conditional=False, **kwargs):
+        if conditional:
+            return await self.fetch_conditional(url, **kwargs)
+
+        limiter = self.limiter(url)
+
+        async with limiter.slot(), self.session.get(url, **kwargs) as response:
+
+            self.check_throttled(limiter, response)
+            self.check_server_error(limiter, response)
 
             if not response.status == 200:
                 raise RequestFailed(f"seems like an unexpected error occurred for this request `{response.reason}`.")
@@ -51,11 +439,112 @@ class Request:
             headers = response.headers.get("content-type")
             return await self.return_content(response, headers)
 
+    async def fetch_conditional(self, url, **kwargs):
+        # revalidates a previously fetched body instead of downloading it again if it hasn't changed
+        key = self.http_cache.make_key(url, kwargs.get("params"))
+        entry = await self.http_cache.get(key)
+        headers = dict(kwargs.pop("headers", None) or {})
+
+        if entry is not None:
+            etag, last_modified, _, _ = entry
+
+            if etag:
+                headers["If-None-Match"] = etag
+
+            if last_modified:
+                headers["If-Modified-Since"] = last_modified
+
+        limiter = self.limiter(url)
+
+        async with limiter.slot(), self.session.get(url, headers=headers, **kwargs) as response:
+
+            self.check_throttled(limiter, response)
+            self.check_server_error(limiter, response)
+
+            if response.status == 304 and entry is not None:
+                self.http_cache.revalidated += 1
+                _, _, content_type, body = entry
+                return self.decode_content(body, content_type)
+
+            if not response.status == 200:
+                raise RequestFailed(f"seems like an unexpected error occurred for this request `{response.reason}`.")
+
+            content_type = response.headers.get("content-type")
+            body = await response.read()
+            etag = response.headers.get("ETag")
+            last_modified = response.headers.get("Last-Modified")
+
+        if etag or last_modified:
+            await self.http_cache.set(key, (etag, last_modified, content_type, body))
+
+        return self.decode_content(body, content_type)
+
+    @error_handle
+    @retry
+    async def download(self, url, path, max_size=None, checksum=None, chunk_size=64 * 1024, **kwargs):
+        """Streams ``url`` to ``path`` without holding the body in memory, returning its size.
+
+        Chunks are written to a temporary file in the default executor which is renamed
+        to ``path`` once it's complete, ``max_size`` is in bytes and ``checksum`` is a
+        sha256 hex digest the body has to match.
+        """
+        limiter = self.limiter(url)
+        tmp = f"{path}.{os.getpid()}.part"
+        digest = hashlib.sha256()
+        size = 0
+
+        file = await self.loop.run_in_executor(None, open, tmp, "wb")
+
+        try:
+
+            async with limiter.slot(), self.session.get(url, **kwargs) as response:
+
+                self.check_throttled(limiter, response)
+                self.check_server_error(limiter, response)
+
+                if not response.status == 200:
+                    raise RequestFailed(f"seems like an unexpected error occurred for this request "
+                                        f"`{response.reason}`.")
+
+                if max_size is not None and (response.content_length or 0) > max_size:
+                    raise DownloadFailed(f"the file is larger than {max_size} bytes.")
+
+                async for chunk in response.content.iter_chunked(chunk_size):
+                    size += len(chunk)
+
+                    if max_size is not None and size > max_size:
+                        raise DownloadFailed(f"the file is larger than {max_size} bytes.")
+
+                    digest.update(chunk)
+                    await self.loop.run_in_executor(None, file.write, chunk)
+
+            await self.loop.run_in_executor(None, file.close)
+
+            if checksum is not None and digest.hexdigest() != checksum.lower():
+                raise DownloadFailed("the downloaded file doesn't match the checksum.")
+
+            await self.loop.run_in_executor(None, os.replace, tmp, path)
+
+        except BaseException:
+            file.close()
+
+            try:
+                os.remove(tmp)
+            except FileNotFoundError:
+                pass
+
+            raise
+
+        return size
+
     @error_handle
     async def post(self, url, **kwargs):
+        limiter = self.limiter(url)
 
-        async with self.session.post(url, **kwargs) as response:
+        async with limiter.slot(), self.session.post(url, **kwargs) as response:
+
+            self.check_throttled(limiter, response)
+            self.check_server_error(limiter, response)
 
             headers = response.headers.get("content-type")
             return await self.return_content(response, headers)
-
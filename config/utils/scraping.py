@@ -0,0 +1,80 @@
+"""
+Extractors for the pages the bot scrapes, so there's one place to fix selectors when a site changes.
+
+Each page declares a strainer so only the nodes it reads are built when parsing,
+and an extract function that turns them into a plain result in the parser pool.
+"""
+from collections import namedtuple
+
+from bs4 import SoupStrainer
+
+from config.utils import parsing
+
+LodestoneCharacter = namedtuple("LodestoneCharacter", "forename surname world avatar portrait")
+SearchResult = namedtuple("SearchResult", "name url world")
+GalleryLink = namedtuple("GalleryLink", "href alt src")
+Gallery = namedtuple("Gallery", "links max_pages")
+
+
+class Page:
+    # subclasses define extract(soup)
+    strainer = None
+
+    @classmethod
+    async def scrape(cls, markup):
+        return await parsing.parse(markup, cls.extract, parse_only=cls.strainer)
+
+
+class LodestoneCharacterPage(Page):
+    strainer = SoupStrainer(class_=("frame__chara__name", "frame__chara__world", "frame__chara__face",
+                                    "character__detail__image"))
+
+    @staticmethod
+    def image(soup, class_):
+        node = soup.find("div", class_=class_)
+        return node.find("img")["src"] if node else None
+
+    @staticmethod
+    def extract(soup):
+        forename, surname = soup.find("p", class_="frame__chara__name").text.split(" ")
+        world = soup.find("p", class_="frame__chara__world").text.split()[0]
+
+        return LodestoneCharacter(forename, surname, world,
+                                  LodestoneCharacterPage.image(soup, "frame__chara__face"),
+                                  LodestoneCharacterPage.image(soup, "character__detail__image"))
+
+
+class FFlogsSearchPage(Page):
+    strainer = SoupStrainer("div", class_="result-list")
+
+    @staticmethod
+    def extract(soup):
+        results = soup.find("div", {"class": "result-list"})
+
+        if not results:
+            return []
+
+        worlds = results.find_all("div", {"class": "server"})
+        return [SearchResult(a.get_text(), a.get("href"), worlds[i].get_text())
+                for i, a in enumerate(results.find_all("a"))]
+
+
+def _gallery_nodes(name, attrs):
+    return attrs.get("id") in ("gallery", "pager-wrap") or attrs.get("alt") == "Nopost"
+
+
+class MirapriGalleryPage(Page):
+    strainer = SoupStrainer(_gallery_nodes)
+
+    @staticmethod
+    def extract(soup):
+        # None when nothing was posted for the search
+        if soup.find("img", {"alt": "Nopost"}):
+            return None
+
+        pager = soup.find("ul", {"id": "pager-wrap"})
+        max_pages = len(pager.find_all("li")) if pager else 1
+        links = [GalleryLink(link.get("href"), link.img.get("alt"), link.img.get("src"))
+                 for link in soup.find("div", {"id": "gallery"}).find_all("a")]
+
+        return Gallery(links, max_pages)
@@ -5,5 +5,22 @@ __fflogs_api_key__ = "api key here"
 __xivapikey__ = "api key here"
 __prefixes__ = ["stuff",  "blank ", "dab "]
 IMAGE_ROOT = "/var/www/img/"
+CACHE_ROOT = "cache/"
+# "record" saves every http response under FIXTURE_ROOT, "replay" serves them back without touching the network
+HTTP_MODE = None
+FIXTURE_ROOT = "fixtures/"
+# seconds added to each replayed response, None uses however long the recorded request took
+REPLAY_LATENCY = None
+# utc hours the fflogs cog pre-fetches current tier parses for saved characters in
+FFLOGS_WARM_HOURS = range(3, 9)
 DOMAIN_NAME = "http://samplename"
 EVENT_CHANNEL_ID = 00000000000
+# per host request limits: requests per second, how many can burst at once and how many can be in flight
+HOST_LIMITS = {
+    "default": {"rate": 5, "burst": 10, "concurrency": 4},
+    "ffxiv.gamerescape.com": {"rate": 2, "burst": 4, "concurrency": 2},
+    "mirapri.com": {"rate": 2, "burst": 4, "concurrency": 2},
+    "eu.finalfantasyxiv.com": {"rate": 1, "burst": 3, "concurrency": 2},
+    "xivapi.com": {"rate": 15, "burst": 20, "concurrency": 8},
+    "www.fflogs.com": {"rate": 5, "burst": 10, "concurrency": 4},
+}
@@ -1,3 +1,4 @@
+import os
 import re
 
 import aiohttp
@@ -20,6 +21,9 @@ from discord.ext import commands
 
 from config.cogs import __cogs__
 from config.utils import requests
+from config.utils import cache
+from config.utils import recording
+from config.utils.catalog import Catalog
 from config.utils.context import Context
 from config import config
 
@@ -31,20 +35,31 @@ class Tataru(commands.Bot):
         self.loop.run_until_complete(self.__ainit__(self, *args, **kwargs))
 
     async def __ainit__(self, *args, **kwargs):
-        self.session = aiohttp.ClientSession()
-        self.request = requests.Request(self, self.session)
+        self.session = recording.wrap_session(aiohttp.ClientSession(), config.HTTP_MODE, config.FIXTURE_ROOT,
+                                              config.REPLAY_LATENCY)
+        http_cache = requests.HttpCache(path=os.path.join(config.CACHE_ROOT, "http"))
+        self.request = requests.Request(self, self.session, config.HOST_LIMITS, http_cache)
         db = await asyncpg.create_pool(config.__credentials__)
         self.pool = db
-        self.pyxivapi = pyxivapi.XIVAPIClient(api_key=config.__xivapikey__)
+        self.pyxivapi = pyxivapi.XIVAPIClient(api_key=config.__xivapikey__, session=self.session)
 
         with open("schema.sql") as f:
             await self.pool.execute(f.read())
 
+        cache.PostgresBackend.pool = self.pool
+        # expired rows in cache_entry are deleted by the schema, this does the same for files under CACHE_ROOT
+        await cache.DiskBackend(config.CACHE_ROOT).sweep()
+        self.catalog = Catalog()
+        await self.catalog.load(self.pool)
+
     async def fetch(self, url, **kwargs):
         return await self.request.fetch(url, **kwargs)
 
-    async def post(self, url, data, **kwargs):
-        return await self.request.post(url, data, **kwargs)
+    async def post(self, url, **kwargs):
+        return await self.request.post(url, **kwargs)
+
+    async def download(self, url, path, **kwargs):
+        return await self.request.download(url, path, **kwargs)
 
     async def get_context(self, message, *, cls=None):
         return await super().get_context(message, cls=Context)
@@ -196,13 +211,76 @@ async def about(ctx):
     embed.add_field(name="Dev:", value="```CaladWoDestroyer#9313```")
     embed.add_field(name="Library:", value=f"```Discord.py {discord.__version__}```")
     embed.add_field(name="Commands:", value=f"```{command_count}```")
-    embed.add_field(name="RAM:", value=f"```Using {h.naturalsize(mem.rss)}```")
+    embed.add_field(name="RAM:", value=f"```Using {h.naturalsize(mem.rss)}\n"
+                                       f"Caches {h.naturalsize(cache.total_bytes())}```")
     embed.add_field(name="VRAM:", value=f"```Using {h.naturalsize(mem.vms)}```")
     embed.add_field(name="Web socket ping", value=f"```{round(ctx.bot.latency * 1000, 2)}```")
     embed.add_field(name="Guilds:", value=guild_count)
     await ctx.send(embed=embed)
 
 
+async def send_table(ctx, rows):
+    widths = [max(len(str(row[i])) for row in rows) for i in range(len(rows[0]))]
+    paginator = commands.Paginator()
+
+    for row in rows:
+        paginator.add_line("  ".join(str(column).ljust(width) for column, width in zip(row, widths)))
+
+    for page in paginator.pages:
+        await ctx.send(page)
+
+
+@commands.is_owner()
+@bot.group(invoke_without_command=True)
+async def caches(ctx):
+    """
+    shows hits, misses and sizes for every cached function
+    -------------------------------------------------------------
+    tataru caches
+    """
+    rows = [("name", "size", "memory", "hits", "misses", "hit %", "evicted", "expired", "refreshed", "saved")]
+
+    for name, func in sorted(cache.registry.items()):
+        stats = func.get_stats()
+        rows.append((name, stats.size, h.naturalsize(stats.bytes), stats.hits, stats.misses,
+                     f"{stats.hit_rate * 100:.0f}", stats.evictions, stats.expirations, stats.refreshes,
+                     f"{stats.time_saved:.1f}s"))
+
+    await send_table(ctx, rows)
+
+
+@commands.is_owner()
+@caches.command(name="clear")
+async def clear_cache(ctx, name):
+    """
+    clears a cache by its name as shown by the caches command
+    -------------------------------------------------------------
+    tataru caches clear fflogs.FFlogs.query_character_data
+    """
+    if name not in cache.registry:
+        return await ctx.send(f"> No cache named `{name}` exists.")
+
+    cache.registry[name].clear()
+    await ctx.send(f"> Cleared `{name}` :white_check_mark:")
+
+
+@commands.is_owner()
+@bot.command()
+async def hosts(ctx):
+    """
+    shows how many requests each host has been sent, how long they queued for and if it's considered down
+    -------------------------------------------------------------
+    tataru hosts
+    """
+    rows = [("host", "requests", "queued", "avg wait", "max wait", "429s", "circuit")]
+
+    for host, limiter in sorted(bot.request.hosts.items()):
+        rows.append((host, limiter.requests, limiter.waiting, f"{limiter.average_wait:.2f}s",
+                     f"{limiter.max_wait:.2f}s", limiter.throttled, limiter.breaker.state))
+
+    await send_table(ctx, rows)
+
+
 if __name__ == "__main__":
     bot.load_extension("jishaku")
     bot.run(config.__bot_token__, bot=True, reconnect=True)
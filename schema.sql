@@ -28,6 +28,9 @@ CREATE TABLE IF NOT EXISTS lodestone_user (
 
 );
 
+-- when the user last ran an fflogs command, characters are warmed in that order
+ALTER TABLE lodestone_user ADD COLUMN IF NOT EXISTS last_active timestamptz;
+
 CREATE TABLE IF NOT EXISTS expansion (
     id SMALLSERIAL PRIMARY KEY,
     name text UNIQUE NOT NULL,
@@ -69,6 +72,46 @@ CREATE TABLE IF NOT EXISTS encounter (
 
 );
 
+CREATE TABLE IF NOT EXISTS static (
+    id SERIAL PRIMARY KEY,
+    guild_id bigint NOT NULL,
+    name text NOT NULL
+);
+
+-- statics are looked up ignoring case so names are unique ignoring case too
+CREATE UNIQUE INDEX IF NOT EXISTS static_guild_name_idx ON static (guild_id, LOWER(name));
+
+CREATE TABLE IF NOT EXISTS static_member (
+    static_id int REFERENCES static (id) ON DELETE CASCADE,
+    user_id bigint REFERENCES lodestone_user (user_id) ON DELETE CASCADE,
+    PRIMARY KEY (static_id, user_id)
+);
+
+CREATE TABLE IF NOT EXISTS fflogs_character (
+    id bigint PRIMARY KEY,
+    name text NOT NULL,
+    world text NOT NULL,
+    region varchar(2),
+    updated_at timestamptz NOT NULL DEFAULT now()
+);
+
+CREATE INDEX IF NOT EXISTS fflogs_character_name_idx ON fflogs_character (LOWER(name), LOWER(world));
+
+-- a character's best parse per encounter, difficulty and metric as of each day it was looked up
+CREATE TABLE IF NOT EXISTS parse_snapshot (
+    character_id bigint REFERENCES fflogs_character (id) ON DELETE CASCADE,
+    encounter_id smallint,
+    difficulty smallint,
+    metric varchar(4),
+    day date DEFAULT CURRENT_DATE,
+    best_percent real,
+    best_amount real,
+    total_kills int,
+    fastest_kill int,
+    spec text,
+    PRIMARY KEY (character_id, encounter_id, difficulty, metric, day)
+);
+
 CREATE TABLE IF NOT EXISTS gamerscape_images (
     id serial PRIMARY KEY,
     title text,
@@ -80,6 +123,17 @@ CREATE TABLE IF NOT EXISTS gamerscape_images (
 
 );
 
+-- unlogged since it's only a cache, it's emptied if postgres crashes
+CREATE UNLOGGED TABLE IF NOT EXISTS cache_entry (
+    namespace text,
+    key text,
+    value bytea NOT NULL,
+    expires_at timestamptz,
+    PRIMARY KEY (namespace, key)
+);
+
+DELETE FROM cache_entry WHERE expires_at <= now();
+
 INSERT INTO expansion (name, patch_number) values('Ew', 6.0) ON CONFLICT DO NOTHING;
 INSERT INTO expansion (name, patch_number) values('ShB', 5.0) ON CONFLICT DO NOTHING;
 INSERT INTO expansion (name, patch_number) values('StB', 4.0) ON CONFLICT DO NOTHING;